@@ -0,0 +1,112 @@
+# Opencast Podcast Studio
+# Copyright 2023 Osnabrück University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''Compare build time and peak memory usage of the feed engines.
+
+The `feedgen` engine is measured with no cached items (cold) and with all
+items cached (warm). Feeds are removed before every build so that they are
+always written.
+
+Usage: python benchmarks/feed_engines.py [episodes ...]
+'''
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from datetime import datetime, timedelta
+
+# Benchmark the podcast studio of this repository without installing it
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from feed_incremental import episode, setup
+
+
+def build(podcast_id, engine, trace=False):
+    from opencastpodcast.config import config
+    from opencastpodcast.feed import update_feeds
+
+    config().setdefault('feed', {})['engine'] = engine
+    feed_dir = config('directories', 'feeds')
+    shutil.rmtree(feed_dir)
+    os.makedirs(feed_dir)
+
+    if trace:
+        tracemalloc.start()
+    t = time.perf_counter()
+    update_feeds([podcast_id])
+    seconds = time.perf_counter() - t
+    if trace:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return peak
+    return seconds
+
+
+def measure(podcast_id, engine, cold=False):
+    '''Measure build time and, in a separate build since tracing slows
+    down the build, peak memory usage.
+    '''
+    from opencastpodcast.db import get_session, Episode
+
+    results = []
+    for trace in (False, True):
+        if cold:
+            db = get_session()
+            db.query(Episode).update({Episode.feed_item: None})
+            db.commit()
+            db.close()
+        results.append(build(podcast_id, engine, trace))
+    return results
+
+
+def run(episodes):
+    from opencastpodcast.db import get_session, Podcast
+
+    podcast_id = f'bench-{episodes}'
+    db = get_session()
+    db.add(Podcast(podcast_id=podcast_id, title='Benchmark',
+                   description='Benchmark podcast', author='Jane Doe',
+                   language='en', category='Education, Courses',
+                   explicit='no', image=f'{podcast_id}.jpg'))
+    start = datetime(2020, 1, 1)
+    db.add_all([episode(podcast_id, i, start + timedelta(hours=i))
+                for i in range(episodes)])
+    db.commit()
+
+    db.close()
+    results = [('feedgen (cold)', *measure(podcast_id, 'feedgen', True)),
+               ('feedgen (warm)', *measure(podcast_id, 'feedgen')),
+               ('stream', *measure(podcast_id, 'stream'))]
+    for engine, seconds, peak in results:
+        print(f'{episodes:>8} episodes: {engine:<15} '
+              f'{seconds * 1000:9.1f} ms {peak / 2**20:9.2f} MiB peak')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('episodes', type=int, nargs='*',
+                        default=[100, 1000, 10000])
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        setup(directory)
+        for episodes in args.episodes:
+            run(episodes)
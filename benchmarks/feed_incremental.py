@@ -0,0 +1,112 @@
+# Opencast Podcast Studio
+# Copyright 2023 Osnabrück University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''Compare a full feed rebuild with an incremental rebuild after publishing
+a single episode.
+
+Usage: python benchmarks/feed_incremental.py [episodes ...]
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import yaml
+
+from datetime import datetime, timedelta
+
+# Benchmark the podcast studio of this repository without installing it
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+
+def setup(directory):
+    '''Point the configuration to a temporary database, feed directory and
+    metrics directory.
+    '''
+    os.makedirs(os.path.join(directory, 'feeds'))
+    cfg = {'database': f'sqlite:///{directory}/benchmark.db',
+           'server': {'base_url': 'https://podcast.example.com'},
+           'directories': {'feeds': os.path.join(directory, 'feeds'),
+                           'metrics': os.path.join(directory, 'metrics')},
+           'loglevel': 'WARNING'}
+    cfgfile = os.path.join(directory, 'opencast-podcast.yml')
+    with open(cfgfile, 'w') as f:
+        yaml.safe_dump(cfg, f)
+
+    from opencastpodcast.config import update_configuration
+    update_configuration(cfgfile)
+
+
+def episode(podcast_id, i, published):
+    from opencastpodcast.db import Episode
+    return Episode(episode_id=f'{podcast_id}-{i}',
+                   podcast_id=podcast_id,
+                   title=f'Lecture {i}',
+                   description=f'Recording of lecture {i}',
+                   author='Jane Doe',
+                   image=f'{podcast_id}.jpg',
+                   published=published,
+                   media_url=f'https://oc.example.com/{podcast_id}/{i}.mp3',
+                   media_size=50_000_000,
+                   media_duration=5_400_000)
+
+
+def run(episodes):
+    from opencastpodcast.db import get_session, Episode, Podcast
+    from opencastpodcast.feed import update_feed
+
+    podcast_id = f'bench-{episodes}'
+    db = get_session()
+    db.add(Podcast(podcast_id=podcast_id, title='Benchmark',
+                   description='Benchmark podcast', author='Jane Doe',
+                   language='en', category='Education, Courses',
+                   explicit='no', image=f'{podcast_id}.jpg'))
+    start = datetime(2020, 1, 1)
+    db.add_all([episode(podcast_id, i, start + timedelta(hours=i))
+                for i in range(episodes)])
+    db.commit()
+
+    # Full rebuild with all items rendered
+    db.query(Episode).update({Episode.feed_item: None})
+    db.commit()
+    t = time.perf_counter()
+    update_feed(podcast_id)
+    full = time.perf_counter() - t
+
+    # Incremental rebuild after publishing one more episode
+    db.add(episode(podcast_id, episodes, start + timedelta(hours=episodes)))
+    db.commit()
+    t = time.perf_counter()
+    update_feed(podcast_id)
+    incremental = time.perf_counter() - t
+    db.close()
+
+    print(f'{episodes:>8} episodes: full {full * 1000:9.1f} ms, '
+          f'incremental {incremental * 1000:9.1f} ms '
+          f'({full / incremental:.1f}x)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('episodes', type=int, nargs='*',
+                        default=[10, 100, 1000, 5000])
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        setup(directory)
+        for episodes in args.episodes:
+            run(episodes)
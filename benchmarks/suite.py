@@ -0,0 +1,310 @@
+# Opencast Podcast Studio
+# Copyright 2023 Osnabrück University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''Measure how feed generation, feed delivery and publication checks scale
+with the number of episodes.
+
+For every dataset size, a synthetic podcast is created in a temporary SQLite
+database. One percent of its episodes are still waiting to be published.
+Opencast is replaced by a local stub server, so the suite runs offline.
+
+For every dataset, the suite measures:
+
+- build time and peak memory of every feed engine
+- size of the feed and its compressed variants
+- latency of feed requests against the web application
+- duration and number of Opencast requests of a watcher check
+
+Results are written as JSON and can be compared with the results of another
+version of the podcast studio.
+
+Usage:
+    python benchmarks/suite.py [-o results.json] [episodes ...]
+    python benchmarks/suite.py --compare old.json new.json
+'''
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Benchmark the podcast studio of this repository without installing it
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from feed_engines import measure
+from feed_incremental import episode, setup
+
+
+class OpencastStub:
+    '''Local stand-in for the Opencast search service which reports all
+    synthetic episodes as published.
+    '''
+
+    def __init__(self):
+        self.series = {}
+        self.published = {}
+        self.requests = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub.requests += 1
+                body = json.dumps(stub.search(self.path)).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        threading.Thread(target=self.server.serve_forever, daemon=True)\
+            .start()
+
+    def mediapackage(self, episode_id):
+        modified = self.published[episode_id].astimezone(timezone.utc)
+        return {'modified': modified.isoformat(), 'mediapackage': {
+            'id': episode_id,
+            'media': {'track': {
+                'type': 'presenter/audio',
+                'url': f'https://oc.example.com/{episode_id}.mp3',
+                'duration': 5_400_000,
+                'size': 50_000_000}}}}
+
+    def search(self, path):
+        params = {k: v[0] for k, v in parse_qs(urlparse(path).query).items()}
+        if 'id' in params:
+            series_id = params['id'].rsplit('-', 1)[0]
+            if params['id'] not in self.series.get(series_id, ()):
+                return {'search-results': {'total': 0}}
+            return {'search-results': {
+                'total': 1, 'result': self.mediapackage(params['id'])}}
+        episodes = self.series.get(params.get('sid'), [])
+        if params.get('sort') == 'DATE_PUBLISHED_DESC':
+            episodes = episodes[::-1]
+        offset = int(params.get('offset', 0))
+        limit = int(params.get('limit', 100))
+        return {'search-results': {
+            'total': len(episodes),
+            'result': [self.mediapackage(episode_id) for episode_id
+                       in episodes[offset:offset + limit]]}}
+
+
+def create_dataset(stub, episodes):
+    '''Create a podcast with the given number of published episodes and one
+    percent of additional episodes waiting to be published.
+
+    :return: Identifier of the podcast
+    '''
+    from opencastpodcast.db import get_session, Podcast
+
+    podcast_id = f'bench-{episodes}'
+    pending = max(1, episodes // 100)
+    db = get_session()
+    db.add(Podcast(podcast_id=podcast_id, title='Benchmark',
+                   description='Benchmark podcast', author='Jane Doe',
+                   language='en', category='Education, Courses',
+                   explicit='no', image=f'{podcast_id}.jpg'))
+    start = datetime(2020, 1, 1)
+    db.add_all([episode(podcast_id, i, start + timedelta(hours=i))
+                for i in range(episodes)])
+    for i in range(episodes, episodes + pending):
+        new = episode(podcast_id, i, start + timedelta(hours=i))
+        new.media_url = new.media_size = new.media_duration = None
+        db.add(new)
+    db.commit()
+    db.close()
+    stub.series[podcast_id] = [f'{podcast_id}-{i}'
+                               for i in range(episodes + pending)]
+    stub.published.update({f'{podcast_id}-{i}': start + timedelta(hours=i)
+                           for i in range(episodes + pending)})
+    return podcast_id
+
+
+def feed_sizes(podcast_id):
+    from opencastpodcast.config import config
+
+    path = os.path.join(config('directories', 'feeds'), f'{podcast_id}.xml')
+    return {name: os.path.getsize(f'{path}{extension}')
+            for name, extension in (('xml', ''), ('gzip', '.gz'),
+                                    ('br', '.br'))
+            if os.path.exists(f'{path}{extension}')}
+
+
+def latency(client, path, headers, requests):
+    '''Request a path several times.
+
+    :return: Dictionary with median and 95th percentile in milliseconds
+    '''
+    timings = []
+    for _ in range(requests):
+        t = time.perf_counter()
+        response = client.get(path, headers=headers)
+        response.get_data()
+        timings.append((time.perf_counter() - t) * 1000)
+    timings.sort()
+    return {'median_ms': statistics.median(timings),
+            'p95_ms': timings[int(len(timings) * 0.95) - 1]}
+
+
+def delivery(podcast_id, requests):
+    '''Measure the latency of feed requests, starting with a feed which
+    was just written and is not yet cached.
+    '''
+    from opencastpodcast.web import app
+
+    client = app.test_client()
+    path = f'/r/{podcast_id}.xml'
+    t = time.perf_counter()
+    etag = client.get(path).headers.get('ETag')
+    results = {'first_ms': (time.perf_counter() - t) * 1000}
+    for name, headers in (('identity', {}),
+                          ('gzip', {'Accept-Encoding': 'gzip'}),
+                          ('not_modified', {'If-None-Match': etag})):
+        results[name] = latency(client, path, headers, requests)
+    return results
+
+
+def watcher_check(stub):
+    '''Measure a publication check of all pending episodes.
+    '''
+    from opencastpodcast.db import get_session, Episode
+    from opencastpodcast.watcher import check
+
+    stub.requests = 0
+    t = time.perf_counter()
+    check()
+    seconds = time.perf_counter() - t
+    db = get_session()
+    pending = db.query(Episode).where(Episode.media_url == None).count()
+    db.close()
+    return {'seconds': seconds, 'requests': stub.requests,
+            'pending_after': pending}
+
+
+def run(stub, episodes, requests):
+    podcast_id = create_dataset(stub, episodes)
+    result = {'episodes': episodes, 'build': {}}
+    for name, engine, cold in (('feedgen_cold', 'feedgen', True),
+                               ('feedgen_warm', 'feedgen', False),
+                               ('stream', 'stream', False)):
+        seconds, peak = measure(podcast_id, engine, cold)
+        result['build'][name] = {'seconds': seconds, 'peak_bytes': peak}
+    result['size'] = feed_sizes(podcast_id)
+    result['delivery'] = delivery(podcast_id, requests)
+    result['watcher'] = watcher_check(stub)
+    return result
+
+
+def version():
+    '''Get the version of the podcast studio being benchmarked.
+    '''
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'],
+                              capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(__file__)).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(data, prefix=''):
+    for key, value in data.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f'{prefix}{key}.')
+        elif isinstance(value, (int, float)):
+            yield f'{prefix}{key}', value
+
+
+def compare(old_file, new_file):
+    '''Print the change of every metric between two result files.
+    '''
+    with open(old_file, 'r') as f:
+        old = json.load(f)
+    with open(new_file, 'r') as f:
+        new = json.load(f)
+    print(f'{old["version"]} → {new["version"]}')
+    old_results = {r['episodes']: dict(flatten(r)) for r in old['results']}
+    for result in new['results']:
+        before = old_results.get(result['episodes'], {})
+        for key, value in flatten(result):
+            if key == 'episodes' or key not in before:
+                continue
+            ratio = value / before[key] if before[key] else float('nan')
+            print(f'{result["episodes"]:>8} {key:<36} {before[key]:>14.4g} '
+                  f'{value:>14.4g} {ratio:>7.2f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('episodes', type=int, nargs='*',
+                        default=[10, 100, 1000, 10000, 50000])
+    parser.add_argument('-r', '--requests', type=int, default=50,
+                        help='Number of requests per latency measurement')
+    parser.add_argument('-o', '--output', default=None,
+                        help='File to write the results to (default: stdout)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='Compare two result files instead of running '
+                             'the benchmarks')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit()
+
+    stub = OpencastStub()
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        setup(directory)
+        from opencastpodcast.config import config
+        config()['opencast'] = {'server': stub.url, 'user': 'admin',
+                                'password': 'opencast'}
+        for episodes in args.episodes:
+            results.append(run(stub, episodes, args.requests))
+            print(f'Finished benchmarks with {episodes} episodes',
+                  file=sys.stderr)
+
+    try:
+        import brotli  # noqa: F401
+        compression = ['gzip', 'br']
+    except ImportError:
+        compression = ['gzip']
+    report = {'version': version(),
+              'date': datetime.now().isoformat(timespec='seconds'),
+              'python': platform.python_version(),
+              'compression': compression,
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
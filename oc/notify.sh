@@ -0,0 +1,11 @@
+#!/bin/sh
+
+# Send a publication notification like Opencast's http-notify workflow
+# operation does. Useful for testing without an Opencast workflow.
+#
+# Usage: notify.sh <podcast studio url> <token> <episode id>
+
+curl -f -X POST \
+  -d "workflowInstanceId=0" \
+  -d "mediaPackageIdentifier=$3" \
+  "$1/api/notify?token=$2"
@@ -15,11 +15,86 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import argparse
-
-from multiprocessing import Process
+import sys
+import time
 
 from opencastpodcast.config import update_configuration
-from opencastpodcast.watcher import run_watcher
+from opencastpodcast.supervisor import start_supervisor, stop_supervisor
+
+
+def init_database():
+    '''Create the database and apply pending migrations before starting
+    processes which would otherwise all try to do that at the same time.
+    '''
+    from opencastpodcast.db import get_session
+
+    get_session().close()
+
+
+def serve_development(args):
+    # Since `app` will use the configuration,
+    # load it only after we updated the configuration location
+    from opencastpodcast.web import app
+
+    # Run watcher and ingest workers
+    init_database()
+    supervisor = start_supervisor()
+
+    # Run development web server
+    try:
+        app.run(debug=args.debug, extra_files=['opencast-podcast.yml'])
+    finally:
+        stop_supervisor(supervisor)
+
+
+def serve_production(args):
+    from opencastpodcast.server import run_server
+
+    init_database()
+    run_server(args.config, args.workers, args.bind)
+
+
+def services(args):
+    from opencastpodcast.supervisor import supervise
+
+    init_database()
+    supervise(args.timeout)
+
+
+def rebuild_feeds(args):
+    from opencastpodcast.feed import rebuild_feeds
+
+    start = time.perf_counter()
+    timings, failures = rebuild_feeds(args.podcast, args.force,
+                                      args.processes)
+    for podcast_id, items, seconds in sorted(timings):
+        print(f'{podcast_id:<32} {items:>6} items {seconds * 1000:>9.1f} ms')
+    for podcast_id, error in sorted(failures):
+        print(f'{podcast_id:<32} failed: {error}')
+    print(f'Rebuilt {len(timings)} feeds in '
+          f'{time.perf_counter() - start:.2f} seconds')
+    if failures:
+        print(f'Failed to rebuild {len(failures)} feeds')
+        sys.exit(1)
+
+
+def update_images(args):
+    from opencastpodcast.images import update_image_variants
+
+    images = update_image_variants(args.force)
+    print(f'Created variants of {images} images')
+
+
+def migrate(args):
+    from opencastpodcast.db import get_session
+    from opencastpodcast.migrations import schema_version, MIGRATIONS
+
+    # Creating a session applies pending migrations
+    session = get_session()
+    version = schema_version(session.connection())
+    session.close()
+    print(f'Database schema is at version {version} '
+          f'(latest: {len(MIGRATIONS)})')
 
 
 if __name__ == '__main__':
@@ -39,17 +114,81 @@ if __name__ == '__main__':
         action='store_true',
         help='Start web server in debug mode'
     )
-    args = parser.parse_args()
-    if args.config:
-        update_configuration(args.config)
+    parser.set_defaults(command=serve_development)
+    subparsers = parser.add_subparsers(title='commands')
 
-    # Since `app` will use the configuration,
-    # load it only after we updated the configuration location
-    from opencastpodcast.web import app
+    serve_parser = subparsers.add_parser(
+        'serve',
+        help='Run the production web server with multiple workers'
+    )
+    serve_parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=None,
+        help='Number of web server workers (default: from configuration)'
+    )
+    serve_parser.add_argument(
+        '-b', '--bind',
+        type=str,
+        default=None,
+        help='Address to listen on (default: from configuration)'
+    )
+    serve_parser.set_defaults(command=serve_production)
 
-    # Run watcher
-    watcher = Process(target=run_watcher)
-    watcher.start()
+    services_parser = subparsers.add_parser(
+        'services',
+        help='Run only the watcher and the ingest workers'
+    )
+    services_parser.add_argument(
+        '-t', '--timeout',
+        type=int,
+        default=30,
+        help='Seconds services get to finish when stopping (default: 30)'
+    )
+    services_parser.set_defaults(command=services)
 
-    # Run web application
-    app.run(debug=args.debug, extra_files=['opencast-podcast.yml'])
+    rebuild_parser = subparsers.add_parser(
+        'rebuild-feeds',
+        help='Rebuild the feeds of all or of selected podcasts'
+    )
+    rebuild_parser.add_argument(
+        'podcast',
+        nargs='*',
+        help='Identifier of a podcast to rebuild the feed for'
+    )
+    rebuild_parser.add_argument(
+        '-f', '--force',
+        default=False,
+        action='store_true',
+        help='Render all episodes, ignoring cached feed items'
+    )
+    rebuild_parser.add_argument(
+        '-p', '--processes',
+        type=int,
+        default=None,
+        help='Number of worker processes (default: number of CPUs)'
+    )
+    rebuild_parser.set_defaults(command=rebuild_feeds)
+
+    images_parser = subparsers.add_parser(
+        'update-images',
+        help='Create missing resized variants of podcast and episode images'
+    )
+    images_parser.add_argument(
+        '-f', '--force',
+        default=False,
+        action='store_true',
+        help='Recreate all variants, e.g. after changing their size'
+    )
+    images_parser.set_defaults(command=update_images)
+
+    migrate_parser = subparsers.add_parser(
+        'migrate',
+        help='Create the database or upgrade its schema to the latest version'
+    )
+    migrate_parser.set_defaults(command=migrate)
+
+    args = parser.parse_args()
+    if args.config:
+        update_configuration(args.config)
+    args.command(args)
@@ -0,0 +1,125 @@
+# Opencast Podcast Studio
+# Copyright 2023 Osnabrück University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''Fingerprinted static assets.
+
+All files of the static folder are read when the application is created,
+named after a hash of their content and compressed ahead of time. Since the
+name of an asset changes whenever its content changes, clients can cache
+assets forever.
+'''
+
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+
+from collections import namedtuple
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Logger
+logger = logging.getLogger(__name__)
+
+# Static file with its content type, ETag and its content by encoding
+Asset = namedtuple('Asset', ('mimetype', 'etag', 'variants'))
+
+# Files worth compressing
+COMPRESSIBLE = ('.css', '.js', '.json', '.svg', '.txt', '.html')
+
+# Brotli quality trading a little size for much faster start-up
+BROTLI_QUALITY = 5
+
+
+def compress(data):
+    '''Compress data with all available content encodings. Variants which are
+    not smaller than the original data are left out.
+
+    :param data: Data to compress
+    :return: Dictionary mapping content encodings to compressed data
+    '''
+    variants = {'gzip': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli:
+        variants['br'] = brotli.compress(data, quality=BROTLI_QUALITY)
+    return {encoding: variant for encoding, variant in variants.items()
+            if len(variant) < len(data)}
+
+
+def fingerprint(filename, digest):
+    '''Add a content hash to a file name, e.g. ``style.<hash>.css``.
+    '''
+    stem, extension = os.path.splitext(filename)
+    return f'{stem}.{digest}{extension}'
+
+
+class Assets:
+    '''Fingerprinted and precompressed files of a static folder kept in
+    memory. Files are loaded when the object is created. Changes to the
+    static folder require a restart.
+    '''
+
+    def __init__(self, directory, exclude=()):
+        '''Load the files of a static folder.
+
+        :param directory: Static folder
+        :param exclude: Paths of files relative to the static folder which are
+                        not served as assets
+        '''
+        self.directory = directory
+        names = {}
+        assets = {}
+        for root, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                filename = os.path.relpath(path, self.directory)\
+                    .replace(os.sep, '/')
+                if filename in exclude:
+                    continue
+                with open(path, 'rb') as f:
+                    data = f.read()
+                digest = hashlib.sha256(data).hexdigest()[:16]
+                variants = {None: data}
+                if filename.endswith(COMPRESSIBLE):
+                    variants.update(compress(data))
+                mimetype = mimetypes.guess_type(filename)[0] \
+                    or 'application/octet-stream'
+                name = fingerprint(filename, digest)
+                names[filename] = name
+                assets[name] = Asset(mimetype, digest, variants)
+        logger.info('Loaded %i static assets from %s', len(assets),
+                    self.directory)
+        self.__names = names
+        self.__assets = assets
+
+    def name(self, filename):
+        '''Get the fingerprinted name of a static file.
+
+        :param filename: Path of the file relative to the static folder
+        :return: Fingerprinted name or None if the file does not exist
+        '''
+        return self.__names.get(filename)
+
+    def get(self, name):
+        '''Get an asset by its fingerprinted name.
+
+        :param name: Fingerprinted name of the asset
+        :return: Asset or None if there is no such asset
+        '''
+        return self.__assets.get(name)
@@ -0,0 +1,117 @@
+# Opencast Podcast Studio
+# Copyright 2023 Osnabrück University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import logging
+import os
+import threading
+
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timezone
+
+# Logger
+logger = logging.getLogger(__name__)
+
+# Cached feed with its ETag, modification date and its content by encoding
+CachedFeed = namedtuple('CachedFeed',
+                        ('generation', 'etag', 'modified', 'variants'))
+
+
+class FeedCache:
+    '''Bounded in-memory LRU cache of feed files and their precompressed
+    variants.
+
+    Cached feeds are invalidated when the feed file or its ETag file are
+    replaced, which is detected based on their modification time and size.
+    The cache is thread-safe.
+    '''
+
+    def __init__(self, max_size, encodings=()):
+        '''Create a new feed cache.
+
+        :param max_size: Maximum number of bytes to keep in memory
+        :param encodings: List of tuples of content encoding and file
+                          extension of precompressed variants
+        '''
+        self.max_size = max_size
+        self.encodings = encodings
+        self.size = 0
+        self.__feeds = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __generation(self, path):
+        generation = []
+        for filename in (path, f'{path}.etag'):
+            try:
+                stat = os.stat(filename)
+                generation.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                generation.append(None)
+        return tuple(generation)
+
+    def __load(self, path, generation):
+        variants = {}
+        with open(path, 'rb') as f:
+            variants[None] = f.read()
+        for encoding, extension in self.encodings:
+            try:
+                with open(f'{path}{extension}', 'rb') as f:
+                    variants[encoding] = f.read()
+            except FileNotFoundError:
+                pass
+        try:
+            with open(f'{path}.etag', 'r') as f:
+                etag = f.read().strip()
+        except FileNotFoundError:
+            etag = hashlib.sha256(variants[None]).hexdigest()[:32]
+        modified = datetime.fromtimestamp(generation[0][0] / 1e9, timezone.utc)
+        return CachedFeed(generation, etag, modified, variants)
+
+    def get(self, path):
+        '''Get a feed from the cache, loading it from disk if it is not
+        cached or outdated.
+
+        :param path: Path of the feed file
+        :return: CachedFeed or None if the feed does not exist
+        '''
+        generation = self.__generation(path)
+        if not generation[0]:
+            return None
+        with self.__lock:
+            feed = self.__feeds.get(path)
+            if feed and feed.generation == generation:
+                self.__feeds.move_to_end(path)
+                return feed
+
+        try:
+            feed = self.__load(path, generation)
+        except FileNotFoundError:
+            return None
+        size = sum(len(data) for data in feed.variants.values())
+        if size > self.max_size:
+            return feed
+
+        with self.__lock:
+            old = self.__feeds.pop(path, None)
+            if old:
+                self.size -= sum(len(d) for d in old.variants.values())
+            self.__feeds[path] = feed
+            self.size += size
+            while self.size > self.max_size:
+                _, evicted = self.__feeds.popitem(last=False)
+                self.size -= sum(len(d) for d in evicted.variants.values())
+        logger.debug('Cached %s (%i bytes)', path, size)
+        return feed
@@ -16,25 +16,25 @@
 
 import logging
 import enum
+import os
+import threading
 
 from functools import wraps
 from datetime import datetime
-from sqlalchemy import create_engine, func, Column, Date, DateTime, String, \
-        Enum, Integer, Text, ForeignKey
+from sqlalchemy import create_engine, event, func, inspect, Boolean, \
+        Column, Date, DateTime, String, Enum, Index, Integer, Text, ForeignKey
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.orm import relationship, scoped_session, sessionmaker
 
 from opencastpodcast.config import config
 
 # Logger
 logger = logging.getLogger(__name__)
 
-# Database uri as described in
-# https://docs.sqlalchemy.org/en/13/core/engines.html#database-urls
-database = config('database') or 'sqlite:///opencast-podcast.db'
-
-# Global session variable. Set on initialization.
+# Global session variables. Set on initialization.
 __session__ = None
+__scoped_session__ = None
+__lock__ = threading.Lock()
 
 # Base Class of all ORM objects.
 Base = declarative_base()
@@ -52,11 +52,28 @@ class Podcast(Base):
     category = Column(String)
     explicit = Column(String)
     image = Column(String)
+    # Resized variants of the image or None if not available
+    image_thumbnail = Column(String)
+    image_cover = Column(String)
+    # Number of items per feed page or None to use the default
+    page_size = Column(Integer)
+    organizational_unit = Column(String)
 
     # Episode relationship
     episodes = relationship('Episode')
 
 
+# Title podcasts are ordered by. Podcasts without a title are ordered like
+# podcasts with an empty title since comparisons with NULL are never true.
+podcast_sort_title = func.coalesce(Podcast.title, '')
+
+# Indexes for listing podcasts ordered by title, optionally filtered by their
+# organizational unit
+Index('ix_podcast_title', podcast_sort_title, Podcast.podcast_id)
+Index('ix_podcast_organizational_unit', Podcast.organizational_unit,
+      podcast_sort_title, Podcast.podcast_id)
+
+
 class Episode(Base):
     """ORM object for podcast episodes.
     """
@@ -67,16 +84,121 @@ class Episode(Base):
     description = Column(Text)
     author = Column(Text)
     image = Column(String)
+    # Resized variants of the image or None if not available
+    image_thumbnail = Column(String)
+    image_cover = Column(String)
     published = Column(DateTime)
     media = Column(String)
     media_url = Column(String)
     media_size = Column(Integer)
     media_duration = Column(Integer)
 
+    # Publication check scheduling
+    check_attempts = Column(Integer, default=0)
+    next_check = Column(DateTime)
+    publication_failed = Column(Boolean, default=False)
+
+    # Cached RSS item of this episode
+    feed_item = Column(Text)
+
+
+# Index for reading the episodes of a podcast ordered by publication date
+Index('ix_episode_podcast_published', Episode.podcast_id, Episode.published)
+
+# Partial index of episodes waiting to be published. Databases not supporting
+# partial indexes index all episodes.
+Index('ix_episode_pending', Episode.next_check,
+      sqlite_where=Episode.media_url == None,
+      postgresql_where=Episode.media_url == None)
+
+# Episode attributes rendered into the cached RSS item
+FEED_ITEM_ATTRIBUTES = ('title', 'description', 'author', 'image',
+                        'image_cover', 'published', 'media_url',
+                        'media_size', 'media_duration')
+
+
+@event.listens_for(Episode, 'before_update')
+def invalidate_feed_item(mapper, connection, episode):
+    """Drop the cached RSS item of an episode if rendered attributes change.
+    """
+    state = inspect(episode)
+    for attribute in FEED_ITEM_ATTRIBUTES:
+        if state.attrs[attribute].history.has_changes():
+            episode.feed_item = None
+            return
+
+
+class JobStatus(enum.Enum):
+    """Status of an ingest job.
+    """
+    pending = 1
+    running = 2
+    failed = 3
+    done = 4
+
+
+class IngestJob(Base):
+    """ORM object for jobs ingesting episodes into Opencast.
+    """
+    __tablename__ = 'ingest_job'
+    episode_id = Column(String, ForeignKey('episode.episode_id'),
+                        primary_key=True)
+    status = Column(Enum(JobStatus), default=JobStatus.pending)
+    attempts = Column(Integer, default=0)
+    error = Column(Text)
+    created = Column(DateTime, default=datetime.now)
+    updated = Column(DateTime, default=datetime.now)
+    run_after = Column(DateTime)
+
+
+class Upload(Base):
+    """ORM object for resumable media uploads.
+    """
+    __tablename__ = 'upload'
+    upload_id = Column(String, primary_key=True)
+    podcast_id = Column(String, ForeignKey('podcast.podcast_id'))
+    extension = Column(String)
+    length = Column(Integer)
+    offset = Column(Integer, default=0)
+    checksum = Column(String)
+    created = Column(DateTime, default=datetime.now)
+
+
+class FeedUpdate(Base):
+    """ORM object for queued feed updates.
+    """
+    __tablename__ = 'feed_update'
+    podcast_id = Column(String, ForeignKey('podcast.podcast_id'),
+                        primary_key=True)
+    # First and latest request since the feed was last built
+    requested = Column(DateTime)
+    updated = Column(DateTime)
+
+
+class Lease(Base):
+    """ORM object for leases electing a single instance to run a task.
+    """
+    __tablename__ = 'lease'
+    name = Column(String, primary_key=True)
+    holder = Column(String)
+    expires = Column(DateTime)
+
+
+class SchemaVersion(Base):
+    """ORM object for applied schema migrations.
+    """
+    __tablename__ = 'schema_version'
+    version = Column(Integer, primary_key=True)
+    applied = Column(DateTime, default=datetime.now)
+
 
 def with_session(f):
     """Wrapper for f to make a SQLAlchemy session present within the function
 
+    The session is the scoped session of the current thread. It is not closed
+    when f returns but needs to be removed at the end of the request using
+    :func:`remove_scoped_session`.
+
     :param f: Function to call
     :type f: Function
     :raises e: Possible exception of f
@@ -84,37 +206,106 @@ def with_session(f):
     """
     @wraps(f)
     def decorated(*args, **kwargs):
-        # Get new session
-        session = get_session()
+        # Get session of this request
+        session = get_scoped_session()
         try:
             # Call f with the session and all the other arguments
-            result = f(session, *args, **kwargs)
+            return f(session, *args, **kwargs)
         except Exception as e:
             # Rollback session, something bad happend.
             session.rollback()
-            session.close()
             raise e
-        # Close session and return the result of f
-        session.close()
-        return result
     return decorated
 
 
+def configure_sqlite(dbapi_connection, connection_record):
+    """Apply the configured pragmas to new SQLite connections.
+
+    Write-ahead logging lets readers continue while another process writes
+    and the busy timeout lets writers wait for locks instead of failing.
+    """
+    sqlite = config('sqlite') or {}
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=%s'
+                   % (sqlite.get('journal_mode') or 'wal'))
+    cursor.execute('PRAGMA busy_timeout=%i'
+                   % (sqlite.get('busy_timeout') or 5000))
+    cursor.execute('PRAGMA synchronous=%s'
+                   % (sqlite.get('synchronous') or 'normal'))
+    cursor.close()
+
+
+def init_engine():
+    """Create the database engine and the session factories of this process,
+    create the tables and apply pending schema migrations.
+    """
+    global __session__, __scoped_session__
+    # Database uri as described in
+    # https://docs.sqlalchemy.org/en/13/core/engines.html#database-urls
+    database = config('database') or 'sqlite:///opencast-podcast.db'
+    # Additional engine options like pool_size or pool_recycle
+    options = config('database_options') or {}
+    Engine = create_engine(
+        database, echo=logger.getEffectiveLevel() == logging.DEBUG,
+        **options)
+    if Engine.dialect.name == 'sqlite':
+        event.listen(Engine, 'connect', configure_sqlite)
+    # Import here since migrations need the models defined above
+    from opencastpodcast.migrations import migrate
+    migrate(Engine)
+    __session__ = sessionmaker(bind=Engine)
+    __scoped_session__ = scoped_session(__session__)
+
+
 def get_session():
     """Get a new session.
 
-    Lazy load the database connection and create the tables.
+    Lazy load the database connection, create the tables and apply pending
+    schema migrations.
 
     Returns:
         sqlalchemy.orm.session.Session -- SQLAlchemy Session object
     """
-    global __session__
     # Create database connection, tables and Sessionmaker if neccessary.
-    if not __session__:
-        Engine = create_engine(
-            database, echo=logger.getEffectiveLevel() == logging.DEBUG)
-        __session__ = sessionmaker(bind=Engine)
-        Base.metadata.create_all(Engine)
+    with __lock__:
+        if not __session__:
+            init_engine()
 
     # Return new session object
     return __session__()
+
+
+def get_scoped_session():
+    """Get the session of the current thread, creating it if necessary.
+
+    Returns:
+        sqlalchemy.orm.session.Session -- SQLAlchemy Session object
+    """
+    with __lock__:
+        if not __scoped_session__:
+            init_engine()
+    return __scoped_session__()
+
+
+def remove_scoped_session():
+    """Close and discard the session of the current thread, if any.
+    """
+    if __scoped_session__:
+        __scoped_session__.remove()
+
+
+def reset_engine():
+    """Forget the database connection of this process so that a new one is
+    created on first use. This is called automatically in forked processes
+    which must not share connections with their parent.
+    """
+    global __session__, __scoped_session__, __lock__
+    if __session__:
+        # Drop pooled connections without closing the parent's connections
+        __session__.kw['bind'].dispose(close=False)
+    __session__ = None
+    __scoped_session__ = None
+    __lock__ = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset_engine)
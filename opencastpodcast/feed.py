@@ -14,25 +14,117 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import gzip
+import hashlib
 import logging
+import multiprocessing
 import os
+import re
+import shutil
+import threading
+import time
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from email.utils import format_datetime
+from feedgen.entry import FeedEntry
+from feedgen.ext.base import BaseExtension
+from feedgen.ext.podcast import PodcastExtension
 from feedgen.feed import FeedGenerator
+from feedgen.util import xml_elem
+from lxml import etree
+from sqlalchemy import or_
 
 from opencastpodcast.config import config
-from opencastpodcast.db import get_session, Podcast
+from opencastpodcast.db import get_session, Episode, FeedUpdate, Podcast
+from opencastpodcast.metrics import feed_build_duration, feed_size
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 
 # Logger
 logger = logging.getLogger(__name__)
 
+# Precompressed variants of feeds by content encoding and file extension
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
 
-def update_feed(podcast_id):
-    logger.info('Generating feed for %s', podcast_id)
-    db = get_session()
-    podcast = db.query(Podcast).where(Podcast.podcast_id == podcast_id).one()
-    base_url = config('server', 'base_url').rstrip('/')
+# Number of rows fetched at once when streaming feeds
+STREAM_BATCH_SIZE = 500
+
+# Columns of episodes needed to stream their items
+STREAM_COLUMNS = (Episode.episode_id, Episode.title, Episode.description,
+                  Episode.author, Episode.image, Episode.image_cover,
+                  Episode.published, Episode.media_url, Episode.media_size,
+                  Episode.media_duration)
+
+# Podcast attributes rendered into the channel of a feed
+CHANNEL_ATTRIBUTES = ('podcast_id', 'title', 'description', 'author', 'image',
+                      'image_cover', 'language', 'explicit', 'category')
+
+# Files of archive pages and their variants
+ARCHIVE_PAGE_FILENAME = re.compile(r'^(\d+)\.xml(\.gz|\.br|\.etag|\.key)?$')
+
+# Characters to escape in text and attributes of streamed items the same way
+# lxml does when serializing items rendered by feedgen
+TEXT_ESCAPES = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;',
+                              '\r': '&#13;'})
+ATTRIBUTE_ESCAPES = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;',
+                                   '"': '&quot;', '\n': '&#10;',
+                                   '\r': '&#13;', '\t': '&#9;'})
+
+# Namespaces used for feed paging and archiving
+ATOM_NS = 'http://www.w3.org/2005/Atom'
+FH_NS = 'http://purl.org/syndication/history/1.0'
+
+
+class HistoryExtension(BaseExtension):
+    '''Feed extension for archived feeds as defined in RFC 5005.
+    '''
+
+    def __init__(self):
+        self.__archive = False
+        self.__links = []
+
+    def extend_ns(self):
+        return {'fh': FH_NS}
+
+    def extend_rss(self, feed):
+        channel = feed[0]
+        if self.__archive:
+            xml_elem(f'{{{FH_NS}}}archive', channel)
+        for rel, href in self.__links:
+            xml_elem(f'{{{ATOM_NS}}}link', channel, href=href, rel=rel)
+        return feed
 
+    def archive(self, archive):
+        '''Mark the feed as archive document.
+        '''
+        self.__archive = archive
+
+    def link(self, rel, href):
+        '''Add a link to another document of the feed, like `current`,
+        `prev-archive` or `next-archive`.
+        '''
+        self.__links.append((rel, href))
+
+
+def render_channel(podcast, base_url, page=None, links=(), last_build=None):
+    '''Render the feed of a podcast without any items.
+
+    :param podcast: Podcast to render the feed for
+    :param base_url: Base URL of the podcast studio
+    :param page: Number of the archive page to render or None for the
+                 subscription document
+    :param links: List of tuples of relation and URL of other documents of
+                  paged feeds
+    :param last_build: Build date to use instead of the current time
+    :return: Tuple of the document up to the position of the items and the
+             rest of the document
+    '''
+    podcast_id = podcast.podcast_id
     fg = FeedGenerator()
     fg.load_extension('podcast')
     fg.id(f'{base_url}/p/{podcast_id}')
@@ -40,31 +132,700 @@ def update_feed(podcast_id):
     fg.description(podcast.description)
     fg.author(name=podcast.author)
     fg.link(href=base_url, rel='alternate')
-    fg.logo(f'{base_url}/i/{podcast.image}')
-    fg.podcast.itunes_image(f'{base_url}/i/{podcast.image}')
-    fg.link(href=f'{base_url}/r/{podcast_id}.xml', rel='self')
+    image = f'{base_url}/i/{podcast.image_cover or podcast.image}'
+    fg.logo(image)
+    fg.podcast.itunes_image(image)
+    fg.link(href=feed_url(base_url, podcast_id, page), rel='self')
     fg.language(podcast.language)
     fg.podcast.itunes_explicit(podcast.explicit)
     # Split into category and subcategory
     category = podcast.category.split(', ')
     fg.podcast.itunes_category(*category)
+    if last_build:
+        fg.lastBuildDate(last_build.astimezone())
+
+    if page or links:
+        fg.register_extension('history', HistoryExtension, rss=True,
+                              atom=False)
+        fg.history.archive(bool(page))
+        for rel, href in links:
+            fg.history.link(rel, href)
+
+    head, tail = fg.rss_str().rsplit(b'</channel>', 1)
+    return head, b'</channel>' + tail
+
+
+def feed_url(base_url, podcast_id, page=None):
+    '''Get the URL of a podcast's feed or of one of its archive pages.
+    '''
+    if page:
+        return f'{base_url}/r/{podcast_id}/{page}.xml'
+    return f'{base_url}/r/{podcast_id}.xml'
+
+
+def render_item(episode, base_url):
+    '''Render the RSS item of an episode.
+
+    :param episode: Published episode to render
+    :param base_url: Base URL of the podcast studio
+    :return: Serialized ``<item>`` element
+    '''
+    fe = FeedEntry()
+    fe.load_extension('podcast')
+    fe.id(f'{base_url}/p/{episode.podcast_id}/{episode.episode_id}')
+    fe.title(episode.title)
+    fe.description(episode.description)
+    fe.published(episode.published.astimezone().isoformat())
+    fe.podcast.itunes_author(episode.author)
+    fe.podcast.itunes_image(
+        f'{base_url}/i/{episode.image_cover or episode.image}')
+    fe.podcast.itunes_duration(episode.media_duration)
+    fe.enclosure(episode.media_url, episode.media_size, 'audio/mpeg')
+
+    # Serialize the item within a channel declaring the namespaces of the
+    # feed so that the item does not declare them on its own
+    nsmap = PodcastExtension().extend_ns()
+    channel = etree.Element('channel', nsmap=nsmap)
+    channel.append(fe.rss_entry())
+    channel = etree.tostring(channel, encoding='unicode')
+    return channel[channel.index('>') + 1:-len('</channel>')]
+
+
+def stream_item(episode, podcast_id, base_url):
+    '''Render the RSS item of an episode without building an element tree.
+    The result is identical to the item rendered by :func:`render_item`.
+
+    :param episode: Row of a published episode with the columns of
+                    :data:`STREAM_COLUMNS`
+    :param podcast_id: Identifier of the podcast the episode belongs to
+    :param base_url: Base URL of the podcast studio
+    :return: Serialized ``<item>`` element
+    '''
+    item = ['<item>']
+    if episode.title:
+        item.append(f'<title>{episode.title.translate(TEXT_ESCAPES)}</title>')
+    if episode.description:
+        description = episode.description.translate(TEXT_ESCAPES)
+        item.append(f'<description>{description}</description>')
+    guid = f'{base_url}/p/{podcast_id}/{episode.episode_id}'
+    item.append(f'<guid isPermaLink="false">'
+                f'{guid.translate(TEXT_ESCAPES)}</guid>')
+    item.append(f'<enclosure '
+                f'url="{episode.media_url.translate(ATTRIBUTE_ESCAPES)}" '
+                f'length="{episode.media_size}" type="audio/mpeg"/>')
+    published = format_datetime(episode.published.astimezone())
+    item.append(f'<pubDate>{published}</pubDate>')
+    if episode.author:
+        author = episode.author.translate(TEXT_ESCAPES)
+        item.append(f'<itunes:author>{author}</itunes:author>')
+    image = f'{base_url}/i/{episode.image_cover or episode.image}'\
+        .translate(ATTRIBUTE_ESCAPES)
+    item.append(f'<itunes:image href="{image}"/>')
+    if episode.media_duration is not None:
+        item.append(f'<itunes:duration>{episode.media_duration}'
+                    '</itunes:duration>')
+    item.append('</item>')
+    return ''.join(item)
 
-    for episode in podcast.episodes:
-        if not episode.media_url:
+
+def feed_items(db, podcast_ids, base_url, force=False):
+    '''Get the RSS items of all published episodes of several podcasts,
+    newest first. Items are rendered only if they are not already cached.
+    Newly rendered items are cached but need to be committed by the caller.
+
+    :param db: Database session to use
+    :param podcast_ids: Identifiers of the podcasts
+    :param base_url: Base URL of the podcast studio
+    :param force: Render all items, ignoring cached items
+    :return: Dictionary mapping podcast identifiers to lists of tuples of
+             publication date and serialized item
+    '''
+    # Load only the cached items first and load full episodes only for items
+    # which need to be rendered
+    episodes = db.query(Episode.podcast_id, Episode.episode_id,
+                        Episode.published, Episode.feed_item)\
+        .where(Episode.podcast_id.in_(podcast_ids))\
+        .where(Episode.media_url != None)\
+        .order_by(Episode.podcast_id, Episode.published.desc(),
+                  Episode.episode_id.desc())\
+        .all()
+    # The cached item is outdated if the base URL changed
+    outdated = [episode_id for podcast_id, episode_id, _, item in episodes
+                if force or not item
+                or f'{base_url}/p/{podcast_id}/{episode_id}<' not in item]
+    rendered = {}
+    for i in range(0, len(outdated), 500):
+        batch = outdated[i:i + 500]
+        for episode in db.query(Episode).where(Episode.episode_id.in_(batch)):
+            episode.feed_item = render_item(episode, base_url)
+            rendered[episode.episode_id] = episode.feed_item
+    logger.debug('Rendered %i of %i items', len(rendered), len(episodes))
+
+    items = {podcast_id: [] for podcast_id in podcast_ids}
+    for podcast_id, episode_id, published, item in episodes:
+        items[podcast_id].append(
+                (published, rendered.get(episode_id) or item))
+    return items
+
+
+def update_feed(podcast_id):
+    logger.info('Generating feed for %s', podcast_id)
+    _, failures = update_feeds([podcast_id])
+    if failures:
+        raise RuntimeError(f'Could not build feed of {podcast_id}: '
+                           f'{failures[0][1]}')
+
+
+def update_feeds(podcast_ids, force=False):
+    '''Rebuild the feeds of several podcasts, loading their episodes in
+    bulk.
+
+    The configured feed engine decides how feeds are built. The `feedgen`
+    engine assembles feeds from cached items, while the `stream` engine
+    renders items while reading them from the database and writes them
+    directly to disk with bounded memory usage.
+
+    A podcast whose feed cannot be built does not keep the feeds of the
+    other podcasts from being built.
+
+    :param podcast_ids: Identifiers of the podcasts to rebuild the feeds of
+    :param force: Render all items, ignoring cached items
+    :return: Tuple of a list of tuples of podcast identifier, number of items
+             and seconds it took to write the feed and a list of tuples of
+             identifier and error of podcasts whose feed failed to build
+    '''
+    db = get_session()
+    base_url = config('server', 'base_url').rstrip('/')
+    feed_dir = config('directories', 'feeds') or 'feeds'
+
+    stream = config('feed', 'engine') == 'stream'
+    items = None
+    if not stream:
+        try:
+            items = feed_items(db, podcast_ids, base_url, force)
+            db.commit()
+        except Exception:
+            # Render the items of every podcast on its own below so that a
+            # broken episode only affects the feed it belongs to
+            db.rollback()
+            logger.warning('Could not render items in bulk', exc_info=True)
+
+    podcasts = db.query(Podcast)\
+        .where(Podcast.podcast_id.in_(podcast_ids))\
+        .all()
+    timings = []
+    failures = []
+    for podcast in podcasts:
+        podcast_id = podcast.podcast_id
+        start = time.perf_counter()
+        try:
+            if stream:
+                count = stream_podcast_feed(db, podcast, base_url, feed_dir,
+                                            force)
+            else:
+                podcast_items = items[podcast_id] if items is not None \
+                    else feed_items(db, [podcast_id], base_url,
+                                    force)[podcast_id]
+                db.commit()
+                count = len(podcast_items)
+                write_podcast_feed(podcast, podcast_items, base_url,
+                                   feed_dir, force)
+        except Exception as e:
+            logger.exception('Failed to build feed of %s', podcast_id)
+            db.rollback()
+            failures.append((podcast_id, str(e)))
             continue
-        fe = fg.add_entry()
-        fe.id(f'{base_url}/p/{podcast_id}/{episode.episode_id}')
-        fe.title(episode.title)
-        fe.description(episode.description)
-        fe.published(episode.published.astimezone().isoformat())
-        fe.podcast.itunes_author(episode.author)
-        fe.podcast.itunes_image(f'{base_url}/i/{episode.image}')
-        fe.podcast.itunes_duration(episode.media_duration)
-        fe.enclosure(episode.media_url, episode.media_size, 'audio/mpeg')
+        seconds = time.perf_counter() - start
+        timings.append((podcast_id, count, seconds))
+        feed_build_duration.observe(seconds)
+        feed_path = os.path.join(feed_dir, f'{podcast_id}.xml')
+        feed_size.observe(os.path.getsize(feed_path))
+    db.close()
+    return timings, failures
+
 
+def write_podcast_feed(podcast, items, base_url, feed_dir, force=False):
+    '''Write the feed of a podcast and its archive pages.
+
+    :param podcast: Podcast to write the feed of
+    :param items: List of tuples of publication date and item, newest first
+    :param base_url: Base URL of the podcast studio
+    :param feed_dir: Directory containing all feeds
+    :param force: Render all archive pages, even unchanged ones
+    '''
+    podcast_id = podcast.podcast_id
+
+    # Split large feeds into archive pages of completed pages of the oldest
+    # items while the subscription document keeps the newest items.
+    links = []
+    pages = 0
+    page_size = podcast.page_size or config('feed', 'page_size')
+    if page_size and len(items) > page_size:
+        pages = len(items) // page_size
+        write_archive(podcast, base_url, feed_dir, items[::-1], page_size,
+                      force)
+        items = items[:page_size]
+        links.append(('prev-archive', feed_url(base_url, podcast_id, pages)))
+    remove_archive_pages(feed_dir, podcast_id, pages)
+
+    head, tail = render_channel(podcast, base_url, links=links)
+    feed_path = os.path.join(feed_dir, f'{podcast_id}.xml')
+    data = head + ''.join(item for _, item in items).encode('utf-8') + tail
+    write_feed(feed_path, data)
+
+
+def rebuild_feeds(podcast_ids=None, force=False, processes=None):
+    '''Rebuild the feeds of all or of selected podcasts using a pool of
+    worker processes.
+
+    :param podcast_ids: Identifiers of podcasts to rebuild or None for all
+    :param force: Render all items, ignoring cached items
+    :param processes: Number of worker processes. Defaults to the number of
+                      CPUs.
+    :return: Tuple of a list of tuples of podcast identifier, number of items
+             and seconds it took to write the feed and a list of tuples of
+             identifier and error of podcasts whose feed failed to build
+    '''
+    db = get_session()
+    query = db.query(Podcast.podcast_id).order_by(Podcast.podcast_id)
+    if podcast_ids:
+        query = query.where(Podcast.podcast_id.in_(podcast_ids))
+    podcast_ids = [podcast_id for podcast_id, in query]
     db.close()
 
-    feed_dir = config('directories', 'feeds') or 'feeds'
+    chunk_size = 50
+    chunks = [podcast_ids[i:i + chunk_size]
+              for i in range(0, len(podcast_ids), chunk_size)]
+    timings = []
+    failures = []
+    # Fork workers so that they inherit the configuration
+    context = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(processes, mp_context=context) as executor:
+        futures = {executor.submit(update_feeds, chunk, force): chunk
+                   for chunk in chunks}
+        for future in as_completed(futures):
+            try:
+                chunk_timings, chunk_failures = future.result()
+            except Exception as e:
+                logger.error('Failed to build feeds %s: %s',
+                             futures[future], e)
+                failures += [(podcast_id, str(e))
+                             for podcast_id in futures[future]]
+                continue
+            timings += chunk_timings
+            failures += chunk_failures
+    return timings, failures
+
+
+def stream_podcast_feed(db, podcast, base_url, feed_dir, force=False):
+    '''Write the feed of a podcast and its archive pages while reading the
+    episodes from the database. At most one page of items is held in memory.
+
+    :param db: Database session to use
+    :param podcast: Podcast to write the feed of
+    :param base_url: Base URL of the podcast studio
+    :param feed_dir: Directory containing all feeds
+    :param force: Render all archive pages, even unchanged ones
+    :return: Number of published episodes
+    '''
+    podcast_id = podcast.podcast_id
+    episodes = db.query(*STREAM_COLUMNS)\
+        .where(Episode.podcast_id == podcast_id)\
+        .where(Episode.media_url != None)
+    count = episodes.count()
+
+    links = []
+    pages = 0
+    newest = episodes.order_by(Episode.published.desc(),
+                               Episode.episode_id.desc())
+    page_size = podcast.page_size or config('feed', 'page_size')
+    if page_size and count > page_size:
+        pages = count // page_size
+        oldest = episodes.order_by(Episode.published, Episode.episode_id)\
+            .limit(pages * page_size)
+        stream_archive(podcast, base_url, feed_dir, oldest, page_size, force)
+        newest = newest.limit(page_size)
+        links.append(('prev-archive', feed_url(base_url, podcast_id, pages)))
+    remove_archive_pages(feed_dir, podcast_id, pages)
+
+    head, tail = render_channel(podcast, base_url, links=links)
     feed_path = os.path.join(feed_dir, f'{podcast_id}.xml')
+    with FeedWriter(feed_path) as writer:
+        writer.write(head)
+        for episode in newest.yield_per(STREAM_BATCH_SIZE):
+            writer.write(stream_item(episode, podcast_id, base_url)
+                         .encode('utf-8'))
+        writer.write(tail)
+    return count
+
+
+def stream_archive(podcast, base_url, feed_dir, episodes, page_size,
+                   force=False):
+    '''Write the archive pages of a podcast feed (RFC 5005) while reading
+    the episodes from the database. The pages are identical to the ones
+    written by :func:`write_archive`.
+
+    :param podcast: Podcast to write the archive pages for
+    :param base_url: Base URL of the podcast studio
+    :param feed_dir: Directory containing all feeds
+    :param episodes: Query of the episodes of all complete pages, oldest
+                     first
+    :param page_size: Number of items per page
+    :param force: Render all pages, even unchanged ones
+    '''
+    podcast_id = podcast.podcast_id
+    archive_dir = os.path.join(feed_dir, podcast_id)
+    os.makedirs(archive_dir, exist_ok=True)
+    page = 1
+    page_items = []
+    for episode in episodes.yield_per(STREAM_BATCH_SIZE):
+        page_items.append(stream_item(episode, podcast_id, base_url))
+        if len(page_items) < page_size:
+            continue
+        links = [('current', feed_url(base_url, podcast_id))]
+        if page > 1:
+            links.append(('prev-archive',
+                          feed_url(base_url, podcast_id, page - 1)))
+        page_path = os.path.join(archive_dir, f'{page}.xml')
+        key = page_key(podcast, base_url, page, links, page_items)
+        if force or not page_unchanged(page_path, key):
+            head, tail = render_channel(podcast, base_url, page, links,
+                                        last_build=episode.published)
+            with FeedWriter(page_path) as writer:
+                writer.write(head)
+                for item in reversed(page_items):
+                    writer.write(item.encode('utf-8'))
+                writer.write(tail)
+            write_atomic(f'{page_path}.key', key.encode('utf-8'))
+        page += 1
+        page_items = []
+
+
+def write_archive(podcast, base_url, feed_dir, items, page_size,
+                  force=False):
+    '''Write the archive pages of a podcast feed (RFC 5005).
+
+    Every archive page contains a fixed range of items, starting with the
+    oldest episodes, and is only rendered if its channel or its items
+    changed.
+    The subscription document overlaps with the newest archive page, but
+    clients identify duplicate items by their guid.
+
+    :param podcast: Podcast to write the archive pages for
+    :param base_url: Base URL of the podcast studio
+    :param feed_dir: Directory containing all feeds
+    :param items: List of publication date and item tuples, oldest first
+    :param page_size: Number of items per page
+    :param force: Render all pages, even unchanged ones
+    '''
+    podcast_id = podcast.podcast_id
+    archive_dir = os.path.join(feed_dir, podcast_id)
+    os.makedirs(archive_dir, exist_ok=True)
+    for page in range(1, len(items) // page_size + 1):
+        page_items = items[(page - 1) * page_size:page * page_size]
+        links = [('current', feed_url(base_url, podcast_id))]
+        if page > 1:
+            links.append(('prev-archive',
+                          feed_url(base_url, podcast_id, page - 1)))
+        page_path = os.path.join(archive_dir, f'{page}.xml')
+        key = page_key(podcast, base_url, page, links,
+                       [item for _, item in page_items])
+        if not force and page_unchanged(page_path, key):
+            continue
+        # Use the newest publication date as build date so that the page
+        # only changes if its items change
+        head, tail = render_channel(podcast, base_url, page, links,
+                                    last_build=page_items[-1][0])
+        items_data = ''.join(item for _, item in reversed(page_items))
+        data = head + items_data.encode('utf-8') + tail
+        write_feed(page_path, data)
+        write_atomic(f'{page_path}.key', key.encode('utf-8'))
+
+
+def page_key(podcast, base_url, page, links, items):
+    '''Get a hash of everything an archive page is rendered from. Items
+    are rendered from their episodes, so the hash changes if an episode of
+    the page changes.
+
+    :param podcast: Podcast the page belongs to
+    :param base_url: Base URL of the podcast studio
+    :param page: Number of the page
+    :param links: Links to other documents of the feed
+    :param items: Serialized items of the page
+    :return: Hash as hex string
+    '''
+    channel = [getattr(podcast, name) for name in CHANNEL_ATTRIBUTES]
+    key = hashlib.sha256(
+        repr((channel, base_url, page, links)).encode('utf-8'))
+    for item in items:
+        key.update(item.encode('utf-8'))
+    return key.hexdigest()[:32]
+
+
+def page_unchanged(page_path, key):
+    '''Check if an archive page was written from the same content already.
+    '''
+    try:
+        with open(f'{page_path}.key', 'r') as f:
+            return f.read().strip() == key and os.path.exists(page_path)
+    except OSError:
+        return False
+
+
+def remove_archive_pages(feed_dir, podcast_id, pages):
+    '''Remove archive pages beyond the current number of pages, e.g. after
+    the page size grew or paging was disabled.
+
+    :param feed_dir: Directory containing all feeds
+    :param podcast_id: Identifier of the podcast
+    :param pages: Current number of archive pages
+    '''
+    archive_dir = os.path.join(feed_dir, podcast_id)
+    try:
+        filenames = os.listdir(archive_dir)
+    except FileNotFoundError:
+        return
+    for filename in filenames:
+        match = ARCHIVE_PAGE_FILENAME.match(filename)
+        if match and int(match.group(1)) > pages:
+            logger.info('Removing archive page file %s of %s', filename,
+                        podcast_id)
+            try:
+                os.remove(os.path.join(archive_dir, filename))
+            except FileNotFoundError:
+                pass
+
+
+def write_feed(feed_path, data):
+    '''Write a feed along with its precompressed variants and its ETag.
+    Nothing is written if the feed did not change.
+
+    A gzip compressed variant is always written. A brotli compressed variant
+    is written if the brotli module is available. The ETag is a hash of the
+    content and is written to a file next to the feed.
+
+    :param feed_path: Path of the feed file
+    :param data: Serialized feed
+    '''
+    etag = hashlib.sha256(data).hexdigest()[:32]
+    try:
+        with open(f'{feed_path}.etag', 'r') as f:
+            if f.read().strip() == etag:
+                logger.debug('Feed %s did not change', feed_path)
+                return
+    except OSError:
+        pass
+
     logger.info('Writing feed to %s', feed_path)
-    fg.rss_file(feed_path)
+    write_atomic(f'{feed_path}.gz',
+                 gzip.compress(data, compresslevel=9, mtime=0))
+    if brotli:
+        write_atomic(f'{feed_path}.br',
+                     brotli.compress(data, quality=brotli_quality()))
+    else:
+        remove_stale(f'{feed_path}.br')
+    write_atomic(feed_path, data)
+    # The ETag is written last, marking the new version as complete
+    write_atomic(f'{feed_path}.etag', etag.encode('utf-8'))
+
+
+class FeedWriter:
+    '''Write a feed to disk piece by piece.
+
+    The feed is written to a temporary file while its ETag is calculated.
+    Once the writer is closed, the feed and its precompressed variants
+    replace the previous version, unless the feed did not change. Like
+    :func:`write_feed`, the ETag is written last.
+
+    Use the writer as context manager to make sure temporary files are
+    removed on errors::
+
+        with FeedWriter(feed_path) as writer:
+            writer.write(data)
+    '''
+
+    def __init__(self, feed_path):
+        '''Create a new feed writer.
+
+        :param feed_path: Path of the feed file
+        '''
+        self.feed_path = feed_path
+        self.__tmp = f'{feed_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        self.__file = open(self.__tmp, 'wb')
+        self.__hash = hashlib.sha256()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type:
+            self.__file.close()
+            os.remove(self.__tmp)
+        else:
+            self.close()
+
+    def write(self, data):
+        '''Append data to the feed.
+
+        :param data: Bytes to write
+        '''
+        self.__file.write(data)
+        self.__hash.update(data)
+
+    def close(self):
+        '''Finish the feed and replace the previous version if it changed.
+
+        :return: If the feed was written
+        '''
+        self.__file.close()
+        etag = self.__hash.hexdigest()[:32]
+        try:
+            with open(f'{self.feed_path}.etag', 'r') as f:
+                if f.read().strip() == etag:
+                    logger.debug('Feed %s did not change', self.feed_path)
+                    os.remove(self.__tmp)
+                    return False
+        except OSError:
+            pass
+
+        logger.info('Writing feed to %s', self.feed_path)
+        try:
+            self.__compress()
+            os.replace(self.__tmp, self.feed_path)
+        except BaseException:
+            if os.path.exists(self.__tmp):
+                os.remove(self.__tmp)
+            raise
+        write_atomic(f'{self.feed_path}.etag', etag.encode('utf-8'))
+        return True
+
+    def __compress(self):
+        for encoding, extension in ENCODINGS:
+            if encoding == 'br' and not brotli:
+                remove_stale(f'{self.feed_path}{extension}')
+                continue
+            tmp_path = f'{self.__tmp}{extension}'
+            try:
+                with open(self.__tmp, 'rb') as src, \
+                        open(tmp_path, 'wb') as dst:
+                    if encoding == 'gzip':
+                        with gzip.GzipFile(filename='', mode='wb',
+                                           fileobj=dst, compresslevel=9,
+                                           mtime=0) as compressed:
+                            shutil.copyfileobj(src, compressed)
+                    else:
+                        compressor = brotli.Compressor(
+                            quality=brotli_quality())
+                        while block := src.read(shutil.COPY_BUFSIZE):
+                            dst.write(compressor.process(block))
+                        dst.write(compressor.finish())
+                os.replace(tmp_path, f'{self.feed_path}{extension}')
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+
+def brotli_quality():
+    '''Get the configured quality of brotli compressed feeds. The highest
+    quality takes many times longer than moderate qualities while saving
+    only a few percent.
+    '''
+    return config('feed', 'brotli_quality') or 5
+
+
+def remove_stale(path):
+    '''Remove a precompressed variant which is no longer written, so that
+    an outdated variant is not delivered.
+    '''
+    try:
+        os.remove(path)
+        logger.info('Removed stale feed variant %s', path)
+    except FileNotFoundError:
+        pass
+
+
+def write_atomic(path, data):
+    '''Write a file by writing a temporary file first and renaming it, so
+    that readers never see partially written files.
+
+    :param path: Path of the file to write
+    :param data: Bytes to write
+    '''
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def request_feed_update(db, podcast_id):
+    '''Queue a rebuild of the feed of a podcast.
+
+    Requests for the same podcast are coalesced and the feed is rebuilt by the
+    watcher once no new requests came in for a short while.
+    The change needs to be committed by the caller.
+
+    :param db: Database session to use
+    :param podcast_id: Identifier of the podcast to rebuild the feed of
+    '''
+    logger.debug('Queueing feed update for %s', podcast_id)
+    now = datetime.now()
+    update = db.get(FeedUpdate, podcast_id)
+    if update:
+        update.updated = now
+    else:
+        db.add(FeedUpdate(podcast_id=podcast_id, requested=now, updated=now))
+
+
+def process_feed_updates(force=False):
+    '''Rebuild all feeds with queued updates which are due.
+
+    An update is due if no new request for the same feed came in during the
+    configured debounce time or if the first request is older than the
+    configured maximum delay. If a feed cannot be built, its update is
+    retried later without holding up the other feeds.
+
+    :param force: Rebuild all queued feeds regardless of their due time
+    :return: Time the next queued update becomes due or None
+    '''
+    db = get_session()
+    now = datetime.now()
+    debounce = timedelta(seconds=config('feed', 'debounce') or 5)
+    max_delay = timedelta(seconds=config('feed', 'max_delay') or 60)
+
+    query = db.query(FeedUpdate.podcast_id, FeedUpdate.updated)
+    if not force:
+        query = query.where(or_(FeedUpdate.updated <= now - debounce,
+                                FeedUpdate.requested <= now - max_delay))
+    for podcast_id, updated in query.all():
+        try:
+            update_feed(podcast_id)
+        except Exception:
+            logger.exception('Failed to build feed of %s', podcast_id)
+            retry = now + timedelta(
+                seconds=config('feed', 'retry_interval') or 300)
+            db.query(FeedUpdate)\
+                .where(FeedUpdate.podcast_id == podcast_id)\
+                .update({FeedUpdate.requested: retry,
+                         FeedUpdate.updated: retry},
+                        synchronize_session=False)
+            db.commit()
+            continue
+        # Keep the request if a new one came in while we were building
+        db.query(FeedUpdate)\
+            .where(FeedUpdate.podcast_id == podcast_id)\
+            .where(FeedUpdate.updated == updated)\
+            .delete()
+        db.commit()
+
+    next_update = None
+    for update in db.query(FeedUpdate):
+        due = min(update.updated + debounce, update.requested + max_delay)
+        next_update = min(next_update or due, due)
+    db.close()
+    return next_update
@@ -0,0 +1,184 @@
+# Opencast Podcast Studio
+# Copyright 2023 Osnabrück University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''Resized variants of uploaded images.
+
+Uploaded images are often large photos. For every image, a small thumbnail
+for the web interface and a square cover of the size required by podcast
+directories for feeds are created. Variants are stored next to the original
+images and named after a hash of their content so that clients can cache
+them forever.
+
+Creating variants requires the Python module `Pillow`. Without it, the
+original images are used everywhere.
+'''
+
+import hashlib
+import io
+import logging
+import os
+import re
+
+from opencastpodcast.config import config
+from opencastpodcast.db import get_session, Episode, Podcast
+from opencastpodcast.feed import request_feed_update
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# Logger
+logger = logging.getLogger(__name__)
+
+# File names of image variants
+VARIANT_FILENAME = re.compile(r'-(thumbnail|cover)-[0-9a-f]{16}\.(jpg|png)$')
+
+
+def variant_sizes():
+    '''Get the configured maximum width and height of all variants.
+
+    :return: Dictionary mapping variant names to sizes in pixels
+    '''
+    images = config('images') or {}
+    return {'thumbnail': images.get('thumbnail_size') or 320,
+            'cover': images.get('cover_size') or 1400}
+
+
+def is_variant(filename):
+    '''Check if a file name is the name of an image variant.
+    '''
+    return bool(VARIANT_FILENAME.search(filename))
+
+
+def encode(image):
+    '''Encode an image as JPEG or, if it is transparent, as PNG.
+
+    :param image: Pillow image to encode
+    :return: Tuple of encoded image and file extension
+    '''
+    data = io.BytesIO()
+    if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+        image.convert('RGBA').save(data, 'PNG', optimize=True)
+        return data.getvalue(), 'png'
+    quality = config('images', 'quality') or 85
+    image.convert('RGB').save(data, 'JPEG', quality=quality, optimize=True,
+                              progressive=True)
+    return data.getvalue(), 'jpg'
+
+
+def save_variant(image, stem, variant):
+    '''Encode and store a variant of an image unless it exists already.
+
+    :param image: Pillow image of the variant
+    :param stem: File name of the original image without extension
+    :param variant: Name of the variant
+    :return: File name of the variant
+    '''
+    upload_dir = config('directories', 'upload') or 'upload'
+    data, extension = encode(image)
+    digest = hashlib.sha256(data).hexdigest()[:16]
+    filename = f'{stem}-{variant}-{digest}.{extension}'
+    path = os.path.join(upload_dir, filename)
+    if not os.path.exists(path):
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return filename
+
+
+def create_variants(filename):
+    '''Create the resized variants of an uploaded image.
+
+    :param filename: Name of the image in the upload directory
+    :return: Dictionary mapping variant names to file names of the variants.
+             Empty if Pillow is not installed or the image cannot be read.
+    '''
+    if Image is None:
+        return {}
+    upload_dir = config('directories', 'upload') or 'upload'
+    stem = os.path.splitext(filename)[0]
+    sizes = variant_sizes()
+    try:
+        with Image.open(os.path.join(upload_dir, filename)) as original:
+            # Let the JPEG decoder scale down large photos while decoding
+            largest = max(sizes.values())
+            original.draft(None, (largest, largest))
+            image = ImageOps.exif_transpose(original)
+
+            size = sizes['thumbnail']
+            thumbnail = image.copy()
+            thumbnail.thumbnail((size, size), Image.LANCZOS)
+
+            # Podcast directories require square covers
+            size = sizes['cover']
+            cover = ImageOps.fit(image, (size, size), Image.LANCZOS)
+
+            return {'thumbnail': save_variant(thumbnail, stem, 'thumbnail'),
+                    'cover': save_variant(cover, stem, 'cover')}
+    except (OSError, Image.DecompressionBombError) as e:
+        logger.warning('Could not create variants of image %s: %s',
+                       filename, e)
+        return {}
+
+
+def update_image_variants(force=False):
+    '''Create missing image variants of all podcasts and episodes and queue
+    updates of the affected feeds.
+
+    :param force: Recreate all variants, e.g. after changing their size
+    :return: Number of images for which variants were created
+    '''
+    if Image is None:
+        raise RuntimeError('The Python module `Pillow` is required to '
+                           'create image variants')
+    db = get_session()
+    images = {}
+    for model in (Podcast, Episode):
+        query = db.query(model.image).distinct()
+        if not force:
+            query = query.where(model.image_cover == None)
+        for image, in query:
+            if image and image not in images:
+                images[image] = create_variants(image)
+
+    podcast_ids = set()
+    for image, variants in images.items():
+        if not variants:
+            continue
+        podcast_ids |= {podcast_id for podcast_id, in db.query(
+            Podcast.podcast_id).where(Podcast.image == image)}
+        db.query(Podcast)\
+            .where(Podcast.image == image)\
+            .update({Podcast.image_thumbnail: variants['thumbnail'],
+                     Podcast.image_cover: variants['cover']},
+                    synchronize_session=False)
+        podcast_ids |= {podcast_id for podcast_id, in db.query(
+            Episode.podcast_id).where(Episode.image == image).distinct()}
+        # Bulk updates bypass the invalidation of cached feed items
+        db.query(Episode)\
+            .where(Episode.image == image)\
+            .update({Episode.image_thumbnail: variants['thumbnail'],
+                     Episode.image_cover: variants['cover'],
+                     Episode.feed_item: None},
+                    synchronize_session=False)
+
+    for podcast_id in podcast_ids:
+        request_feed_update(db, podcast_id)
+    db.commit()
+    db.close()
+    return sum(1 for variants in images.values() if variants)
@@ -0,0 +1,178 @@
+# Opencast Podcast Studio
+# Copyright 2023 Osnabrück University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import os
+import threading
+import time
+
+from datetime import datetime, timedelta
+from sqlalchemy import or_
+
+from opencastpodcast.config import config
+from opencastpodcast.db import get_session, Episode, IngestJob, JobStatus
+from opencastpodcast.lease import acquire_lease, holder_id, release_lease
+from opencastpodcast.metrics import ingest_duration, registry
+from opencastpodcast.opencast import create_episode
+
+
+# Logger
+logger = logging.getLogger(__name__)
+
+
+def claim_job():
+    '''Claim the next pending ingest job which is due.
+
+    :return: Identifier of the episode to ingest or None
+    '''
+    db = get_session()
+    now = datetime.now()
+    candidates = db.query(IngestJob.episode_id)\
+        .where(IngestJob.status == JobStatus.pending)\
+        .where(or_(IngestJob.run_after == None, IngestJob.run_after <= now))\
+        .order_by(IngestJob.created)\
+        .limit(10)\
+        .all()
+    for episode_id, in candidates:
+        # Only one worker will succeed in changing the status
+        claimed = db.query(IngestJob)\
+            .where(IngestJob.episode_id == episode_id)\
+            .where(IngestJob.status == JobStatus.pending)\
+            .update({IngestJob.status: JobStatus.running,
+                     IngestJob.attempts: IngestJob.attempts + 1,
+                     IngestJob.updated: now},
+                    synchronize_session=False)
+        db.commit()
+        if claimed:
+            db.close()
+            return episode_id
+    db.close()
+    return None
+
+
+def run_job(episode_id):
+    '''Ingest an episode into Opencast and update its job accordingly.
+
+    Failed jobs are retried with a growing delay until the configured number
+    of attempts is reached.
+
+    :param episode_id: Identifier of the episode to ingest
+    '''
+    db = get_session()
+    job = db.get(IngestJob, episode_id)
+    episode = db.get(Episode, episode_id)
+    start = time.perf_counter()
+    try:
+        create_episode(episode)
+    except Exception as e:
+        ingest_duration.observe(time.perf_counter() - start, result='failed')
+        logger.warning('Episode %s: Ingest attempt %i failed: %s',
+                       episode_id, job.attempts, e)
+        max_attempts = config('ingest', 'max_attempts') or 5
+        retry_interval = config('ingest', 'retry_interval') or 60
+        job.error = str(e)
+        job.updated = datetime.now()
+        if job.attempts >= max_attempts:
+            logger.error('Episode %s: Giving up on ingest', episode_id)
+            job.status = JobStatus.failed
+        else:
+            job.status = JobStatus.pending
+            delay = retry_interval * 2 ** (job.attempts - 1)
+            job.run_after = job.updated + timedelta(seconds=delay)
+        db.commit()
+        db.close()
+        return
+
+    ingest_duration.observe(time.perf_counter() - start, result='done')
+
+    # Let the watcher start checking for the publication
+    episode.check_attempts = 0
+    episode.next_check = None
+    job.status = JobStatus.done
+    job.error = None
+    job.updated = datetime.now()
+    db.commit()
+
+    # Only delete the file once the job is done so that a failure here cannot
+    # cause the episode to be ingested again
+    upload_tmp_dir = config('directories', 'upload_tmp') or 'upload_tmp'
+    logger.info('Deleting temporary file %s', episode.media)
+    try:
+        os.remove(os.path.join(upload_tmp_dir, episode.media))
+    except OSError as e:
+        logger.error('Episode %s: Could not delete temporary file: %s',
+                     episode_id, e)
+    db.close()
+
+
+def reset_jobs():
+    '''Put jobs which were interrupted while running back into the queue.
+    '''
+    db = get_session()
+    reset = db.query(IngestJob)\
+        .where(IngestJob.status == JobStatus.running)\
+        .update({IngestJob.status: JobStatus.pending},
+                synchronize_session=False)
+    db.commit()
+    db.close()
+    if reset:
+        logger.info('Re-queued %i interrupted ingest jobs', reset)
+
+
+def worker():
+    '''Process ingest jobs until the process is terminated.
+    '''
+    poll_interval = config('ingest', 'poll_interval') or 5
+    while True:
+        registry.save_if_due()
+        try:
+            episode_id = claim_job()
+            if episode_id:
+                run_job(episode_id)
+                continue
+        except Exception:
+            logger.exception('Error while processing ingest jobs')
+        time.sleep(poll_interval)
+
+
+def run_ingest():
+    '''Run a pool of workers ingesting uploaded episodes into Opencast.
+
+    Workers only run on the instance holding the ingest lease, so that jobs
+    interrupted on one instance are not re-queued while another instance is
+    still running them. If the lease is lost, this function returns and the
+    workers are stopped along with the process.
+    '''
+    lease_duration = config('server', 'lease_duration') or 60
+    holder = holder_id()
+    while not acquire_lease('ingest', holder, lease_duration):
+        time.sleep(lease_duration / 3)
+    logger.info('Acquired ingest lease as %s', holder)
+
+    try:
+        reset_jobs()
+        workers = config('ingest', 'workers') or 2
+        logger.info('Starting %i ingest workers', workers)
+        threads = [threading.Thread(target=worker, daemon=True)
+                   for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        # Renew the lease while the workers are running
+        while acquire_lease('ingest', holder, lease_duration):
+            time.sleep(lease_duration / 3)
+        logger.error('Lost ingest lease')
+    finally:
+        release_lease('ingest', holder)
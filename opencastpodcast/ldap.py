@@ -15,8 +15,12 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import logging
+import os
+import threading
+import time
 
-from ldap3 import Server, Connection, ALL, AUTO_BIND_NO_TLS
+from ldap3 import Server, Connection, ALL, BASE
+from ldap3.core.exceptions import LDAPBindError, LDAPCommunicationError
 from ldap3.utils import conv
 
 from opencastpodcast.config import config
@@ -24,15 +28,176 @@ from opencastpodcast.config import config
 # Logger
 logger = logging.getLogger(__name__)
 
+# Server of this process. Set on first use.
+__server__ = None
+__pools__ = {}
+__lock__ = threading.Lock()
+
+
+def get_server():
+    '''Get the LDAP server. Information about the server and its schema is
+    read on the first bind and shared by all connections of this process.
+    '''
+    global __server__
+    with __lock__:
+        if not __server__:
+            __server__ = Server(config('ldap', 'server'),
+                                port=config('ldap', 'port'),
+                                use_ssl=True,
+                                get_info=ALL,
+                                connect_timeout=config('ldap', 'timeout')
+                                or 10)
+    return __server__
+
 
 def connect(user_dn=None, password=None):
-    server = Server(config('ldap', 'server'),
-                    port=config('ldap', 'port'),
-                    use_ssl=True,
-                    get_info=ALL)
-    # Note: AUTO_BIND_NO_TLS means no Start TLS
+    '''Open a new connection and bind to the server. Server information is
+    only read if it has not been read before.
+
+    :param user_dn: DN to bind with or None for an anonymous bind
+    :param password: Password to bind with
+    :return: Bound connection
+    :raises LDAPBindError: If the credentials are invalid
+    '''
+    server = get_server()
+    conn = Connection(server, user_dn, password,
+                      receive_timeout=config('ldap', 'timeout') or 10)
+    # Note: No Start TLS
     # See: https://github.com/cannatag/ldap3/issues/1061
-    return Connection(server, user_dn, password, auto_bind=AUTO_BIND_NO_TLS)
+    conn.open()
+    if not conn.bind(read_server_info=server.info is None):
+        error = conn.last_error
+        conn.unbind()
+        raise LDAPBindError(error)
+    return conn
+
+
+class ConnectionPool:
+    '''Pool of bound connections reused across requests.
+
+    Connections are checked before they are reused if they were idle for a
+    while and replaced if they failed. The pool is thread-safe.
+    '''
+
+    def __init__(self, user_dn=None, password=None, size=4,
+                 check_interval=60):
+        '''Create a new connection pool.
+
+        :param user_dn: DN to bind with or None for anonymous connections
+        :param password: Password to bind with
+        :param size: Maximum number of idle connections to keep
+        :param check_interval: Seconds after which idle connections are
+                               checked before being reused
+        '''
+        self.user_dn = user_dn
+        self.password = password
+        self.size = size
+        self.check_interval = check_interval
+        self.__idle = []
+        self.__lock = threading.Lock()
+
+    def __healthy(self, conn, idle_since):
+        if conn.closed or not conn.bound:
+            return False
+        if time.monotonic() - idle_since < self.check_interval:
+            return True
+        # Read the root DSE without any attributes
+        try:
+            return conn.search('', '(objectClass=*)', search_scope=BASE,
+                               attributes=['1.1'])
+        except LDAPCommunicationError:
+            return False
+
+    def take(self):
+        '''Take a healthy connection out of the pool or open a new one.
+        '''
+        while True:
+            with self.__lock:
+                if not self.__idle:
+                    break
+                conn, idle_since = self.__idle.pop()
+            if self.__healthy(conn, idle_since):
+                return conn
+            logger.debug('Discarding broken LDAP connection')
+            close(conn)
+        return connect(self.user_dn, self.password)
+
+    def give(self, conn):
+        '''Return a connection to the pool.
+        '''
+        with self.__lock:
+            if len(self.__idle) < self.size:
+                self.__idle.append((conn, time.monotonic()))
+                return
+        close(conn)
+
+    def run(self, operation):
+        '''Run an operation on a pooled connection. If the connection fails,
+        the operation is retried once on a new connection.
+
+        :param operation: Function taking a connection
+        :return: Result of the operation
+        '''
+        for attempt in range(2):
+            conn = self.take()
+            try:
+                result = operation(conn)
+            except LDAPCommunicationError as e:
+                close(conn)
+                if attempt:
+                    raise
+                logger.warning('LDAP connection failed, reconnecting: %s', e)
+                continue
+            self.give(conn)
+            return result
+
+    def clear(self):
+        '''Close all idle connections.
+        '''
+        with self.__lock:
+            idle, self.__idle = self.__idle, []
+        for conn, _ in idle:
+            close(conn)
+
+
+def close(conn):
+    try:
+        conn.unbind()
+    except LDAPCommunicationError:
+        pass
+
+
+def get_pool(name):
+    '''Get the pool of anonymous or of service connections.
+
+    :param name: Either `anonymous` or `service`
+    :return: Connection pool
+    '''
+    with __lock__:
+        if name not in __pools__:
+            credentials = (None, None)
+            if name == 'service':
+                credentials = (config('ldap', 'bind_dn'),
+                               config('ldap', 'bind_pass'))
+            __pools__[name] = ConnectionPool(
+                *credentials,
+                size=config('ldap', 'pool_size') or 4,
+                check_interval=config('ldap', 'check_interval') or 60)
+        return __pools__[name]
+
+
+def reset_connections():
+    '''Forget all connections of this process without closing them. This is
+    called automatically in forked processes which must not share connections
+    with their parent.
+    '''
+    global __server__, __pools__, __lock__
+    __server__ = None
+    __pools__ = {}
+    __lock__ = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset_connections)
 
 
 def ldap_login(username: str, password: str) -> dict[str, list]:
@@ -49,6 +214,7 @@ def ldap_login(username: str, password: str) -> dict[str, list]:
     user_dn = config('ldap', 'user_dn').format(username=username)
 
     logger.debug('Trying to log into LDAP with user_dn `%s`', user_dn)
+    # User binds use short-lived connections which are never shared
     conn = connect(user_dn, password)
     logger.debug('Login successful with user_dn `%s`', user_dn)
 
@@ -59,14 +225,18 @@ def ldap_login(username: str, password: str) -> dict[str, list]:
     attributes += config('ldap', 'userdata', 'groups', 'fields') or []
 
     logger.debug('Searching for user data')
-    conn.search(
-            config('ldap', 'base_dn'),
-            config('ldap', 'search_filter').format(username=username),
-            attributes=attributes)
-    if len(conn.entries) != 1:
-        raise ValueError('Search must return exactly one result', conn.entries)
+    try:
+        conn.search(
+                config('ldap', 'base_dn'),
+                config('ldap', 'search_filter').format(username=username),
+                attributes=attributes)
+        entries = conn.entries
+    finally:
+        close(conn)
+    if len(entries) != 1:
+        raise ValueError('Search must return exactly one result', entries)
     logger.debug('Found user data')
-    return conn.entries[0].entry_attributes_as_dict
+    return entries[0].entry_attributes_as_dict
 
 
 def check_login(username: str) -> bool:
@@ -77,12 +247,13 @@ def check_login(username: str) -> bool:
     '''
     username = conv.escape_filter_chars(username, encoding=None)
     logger.debug('Probing for user `%s` in LDAP', username)
-    conn = connect()
 
-    logger.debug('Searching for user data')
-    conn.search(config('ldap', 'base_dn'),
-                config('ldap', 'search_filter').format(username=username))
-    return len(conn.entries) > 0
+    def search(conn):
+        logger.debug('Searching for user data')
+        conn.search(config('ldap', 'base_dn'),
+                    config('ldap', 'search_filter').format(username=username))
+        return len(conn.entries) > 0
+    return get_pool('anonymous').run(search)
 
 
 def check_for_user(given: str, family: str, birth: int) -> list:
@@ -99,8 +270,10 @@ def check_for_user(given: str, family: str, birth: int) -> list:
             birth=birth)
 
     logger.debug('Probing for user: %s', search_filter)
-    conn = connect(config('ldap', 'bind_dn'), config('ldap', 'bind_pass'))
 
-    logger.debug('Searching for user data')
-    conn.search(config('ldap', 'base_dn'), search_filter, attributes=['uid'])
-    return [e['uid'] for e in conn.entries]
+    def search(conn):
+        logger.debug('Searching for user data')
+        conn.search(config('ldap', 'base_dn'), search_filter,
+                    attributes=['uid'])
+        return [e['uid'] for e in conn.entries]
+    return get_pool('service').run(search)
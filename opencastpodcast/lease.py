@@ -0,0 +1,82 @@
+# Opencast Podcast Studio
+# Copyright 2023 Osnabrück University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import os
+import socket
+
+from datetime import datetime, timedelta
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+
+from opencastpodcast.db import get_session, Lease
+
+# Logger
+logger = logging.getLogger(__name__)
+
+
+def holder_id():
+    '''Get an identifier of this process which is unique within a cluster.
+    '''
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def acquire_lease(name, holder, duration):
+    '''Acquire or renew a lease. A lease can only be acquired if it is not
+    held by someone else or if it expired.
+
+    Leases rely on the clocks of all instances being synchronized.
+
+    :param name: Name of the lease
+    :param holder: Identifier of the instance acquiring the lease
+    :param duration: Seconds until the lease expires unless it is renewed
+    :return: If the lease is held by the given holder
+    '''
+    db = get_session()
+    now = datetime.now()
+    expires = now + timedelta(seconds=duration)
+    try:
+        acquired = db.query(Lease)\
+            .where(Lease.name == name)\
+            .where(or_(Lease.holder == holder, Lease.expires < now))\
+            .update({Lease.holder: holder, Lease.expires: expires},
+                    synchronize_session=False)
+        db.commit()
+        if not acquired:
+            # Create the lease if it does not exist yet
+            db.add(Lease(name=name, holder=holder, expires=expires))
+            db.commit()
+    except IntegrityError:
+        db.rollback()
+        return False
+    finally:
+        db.close()
+    return True
+
+
+def release_lease(name, holder):
+    '''Release a lease so that other instances can acquire it right away.
+
+    :param name: Name of the lease
+    :param holder: Identifier of the instance holding the lease
+    '''
+    db = get_session()
+    db.query(Lease)\
+        .where(Lease.name == name)\
+        .where(Lease.holder == holder)\
+        .update({Lease.expires: datetime.now()}, synchronize_session=False)
+    db.commit()
+    db.close()
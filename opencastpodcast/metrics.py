@@ -0,0 +1,420 @@
+# Opencast Podcast Studio
+# Copyright 2023 Osnabrück University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''Metrics in the Prometheus text format.
+
+Every process records metrics in its own in-memory registry. Recording a
+value only takes a lock and a few additions, so metrics can be recorded on
+hot paths. To share metrics between the web server, the watcher and the
+ingest workers, every process regularly writes a snapshot of its registry to
+the metrics directory. The metrics endpoint merges the snapshots of all
+running processes with the live registry of the serving process.
+
+Processes exit, e.g. when Gunicorn replaces a worker. To keep counters and
+histograms from going down, the last snapshot of a process which is no longer
+running is added to an aggregate of all finished processes. Running processes
+hold a lock on a file named like their snapshot, so that a process ID reused
+by a new process cannot be mistaken for the old one.
+'''
+
+import bisect
+import fcntl
+import json
+import logging
+import math
+import os
+import secrets
+import threading
+import time
+
+from opencastpodcast.config import config
+
+# Logger
+logger = logging.getLogger(__name__)
+
+# Default buckets for durations in seconds
+DURATION_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+# Name of the snapshot of all processes which are no longer running
+AGGREGATE = 'aggregate'
+
+# Buckets for sizes in bytes
+SIZE_BUCKETS = (1024, 10 * 1024, 100 * 1024, 1024**2, 10 * 1024**2,
+                100 * 1024**2)
+
+
+class Metric:
+    '''Base class of metrics with values for combinations of label values.
+    '''
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def reset(self):
+        '''Remove all recorded values.
+        '''
+        with self._lock:
+            self._values = {}
+
+    def snapshot(self):
+        '''Get all recorded values.
+
+        :return: List of tuples of label values and recorded value
+        '''
+        with self._lock:
+            return [(list(key), value) for key, value in self._values.items()]
+
+
+class Counter(Metric):
+    '''Metric which only ever increases, like the number of requests.
+    '''
+    type = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    '''Metric which can go up and down, like the number of pending episodes.
+    '''
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    '''Metric counting observations in buckets, like request durations.
+    '''
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=DURATION_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            values = self._values.get(key)
+            if not values:
+                # Observations per bucket, the last bucket being +Inf,
+                # followed by the sum of all observations
+                values = self._values[key] = [0] * (len(self.buckets) + 2)
+            values[bucket] += 1
+            values[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return [(list(key), list(value))
+                    for key, value in self._values.items()]
+
+
+class Registry:
+    '''Collection of metrics of one process.
+    '''
+
+    def __init__(self):
+        self.metrics = {}
+        self.__name = None
+        self.__lock_file = None
+        self.__due = 0
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(),
+                  buckets=DURATION_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def reset(self):
+        '''Remove all recorded values, e.g. in a forked process which must
+        not report the values of its parent.
+        '''
+        for metric in self.metrics.values():
+            metric.reset()
+        if self.__lock_file:
+            # Closing the inherited file keeps the lock of the parent
+            self.__lock_file.close()
+        self.__name = None
+        self.__lock_file = None
+        self.__due = 0
+
+    def snapshot(self):
+        '''Get the recorded values of all metrics.
+
+        :return: Dictionary mapping metric names to recorded values
+        '''
+        return {name: metric.snapshot()
+                for name, metric in self.metrics.items()}
+
+    def __lock(self, metrics_dir):
+        '''Name the snapshot of this process and lock it for as long as the
+        process is running.
+        '''
+        if not self.__name:
+            name = f'{os.getpid()}-{secrets.token_hex(4)}'
+            lock_file = open(os.path.join(metrics_dir, f'{name}.lock'), 'w')
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self.__name = name
+            self.__lock_file = lock_file
+        return self.__name
+
+    def save(self):
+        '''Write a snapshot of the registry to the metrics directory.
+        '''
+        metrics_dir = config('directories', 'metrics') or 'metrics'
+        try:
+            os.makedirs(metrics_dir, exist_ok=True)
+            name = self.__lock(metrics_dir)
+            dump(self.snapshot(), os.path.join(metrics_dir, f'{name}.json'))
+        except OSError as e:
+            logger.warning('Could not save metrics: %s', e)
+        interval = config('metrics', 'interval') or 15
+        self.__due = time.monotonic() + interval
+
+    def save_if_due(self):
+        '''Write a snapshot of the registry if the last one is older than the
+        configured interval. This is cheap enough to be called often.
+        '''
+        if time.monotonic() >= self.__due:
+            self.save()
+
+    def merge(self, collected, snapshot, gauges=True):
+        '''Add the values of a snapshot to collected values.
+
+        :param collected: Dictionary mapping metric names to dictionaries
+                          mapping label values to the merged values
+        :param snapshot: Snapshot to add
+        :param gauges: If the values of gauges should be added
+        '''
+        for name, values in snapshot.items():
+            metric = self.metrics.get(name)
+            if not metric or (metric.type == 'gauge' and not gauges):
+                continue
+            merged = collected.setdefault(name, {})
+            for key, value in values:
+                key = tuple(key)
+                if metric.type == 'gauge' or key not in merged:
+                    merged[key] = value
+                elif metric.type == 'counter':
+                    merged[key] += value
+                else:
+                    merged[key] = [a + b for a, b in zip(merged[key], value)]
+
+    def collect(self):
+        '''Collect the values of this process, the snapshots of all other
+        running processes and the aggregate of all processes which are no
+        longer running. Snapshots of processes which are no longer running
+        are added to the aggregate and removed. Their gauges are dropped.
+
+        :return: Dictionary mapping metric names to dictionaries mapping
+                 label values to the merged values
+        '''
+        collected = {name: {} for name in self.metrics}
+        self.merge(collected, self.snapshot())
+        metrics_dir = config('directories', 'metrics') or 'metrics'
+        aggregate_path = os.path.join(metrics_dir, f'{AGGREGATE}.json')
+        try:
+            os.makedirs(metrics_dir, exist_ok=True)
+            # Only one process at a time may move snapshots to the aggregate
+            lock_path = os.path.join(metrics_dir, f'{AGGREGATE}.lock')
+            with open(lock_path, 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                aggregate = {}
+                self.merge(aggregate, load(aggregate_path) or {})
+                finished = []
+                for filename in os.listdir(metrics_dir):
+                    name, extension = os.path.splitext(filename)
+                    if extension != '.json' \
+                            or name in (AGGREGATE, self.__name):
+                        continue
+                    snapshot = load(os.path.join(metrics_dir, filename))
+                    if snapshot is None:
+                        continue
+                    if running(metrics_dir, name):
+                        self.merge(collected, snapshot)
+                    else:
+                        self.merge(aggregate, snapshot, gauges=False)
+                        finished.append(name)
+
+                aggregate = {name: [(list(key), value)
+                                    for key, value in values.items()]
+                             for name, values in aggregate.items()}
+                if finished:
+                    logger.debug('Adding metrics of finished processes %s '
+                                 'to the aggregate', finished)
+                    dump(aggregate, aggregate_path)
+                    for name in finished:
+                        remove(os.path.join(metrics_dir, f'{name}.json'))
+                        remove(os.path.join(metrics_dir, f'{name}.lock'))
+                self.merge(collected, aggregate)
+        except OSError as e:
+            logger.warning('Could not collect metrics: %s', e)
+        return collected
+
+    def exposition(self):
+        '''Render all metrics of all processes in the Prometheus text format.
+
+        :return: Metrics as string
+        '''
+        lines = []
+        for name, values in self.collect().items():
+            metric = self.metrics[name]
+            lines.append(f'# HELP {name} {metric.documentation}')
+            lines.append(f'# TYPE {name} {metric.type}')
+            for key, value in sorted(values.items()):
+                labels = list(zip(metric.labels, key))
+                if metric.type != 'histogram':
+                    lines.append(f'{name}{format_labels(labels)} '
+                                 f'{format_value(value)}')
+                    continue
+                cumulative = 0
+                bounds = metric.buckets + (math.inf,)
+                for bound, count in zip(bounds, value):
+                    cumulative += count
+                    bucket_labels = labels + [('le', format_value(bound))]
+                    lines.append(f'{name}_bucket{format_labels(bucket_labels)}'
+                                 f' {cumulative}')
+                lines.append(f'{name}_sum{format_labels(labels)} '
+                             f'{format_value(value[-1])}')
+                lines.append(f'{name}_count{format_labels(labels)} '
+                             f'{cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    labels = ','.join(
+        '{}="{}"'.format(label, value.replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for label, value in labels)
+    return f'{{{labels}}}'
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def running(metrics_dir, name):
+    '''Check if the process which wrote a snapshot is still running.
+
+    :param metrics_dir: Directory containing the snapshot
+    :param name: Name of the snapshot without extension
+    :return: If the process still holds the lock of its snapshot
+    '''
+    path = os.path.join(metrics_dir, f'{name}.lock')
+    with open(path, 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+    return False
+
+
+def load(path):
+    '''Load a snapshot.
+
+    :return: Snapshot or None if it cannot be read
+    '''
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def dump(snapshot, path):
+    '''Write a snapshot atomically.
+    '''
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(tmp_path, path)
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+# Registry of this process
+registry = Registry()
+os.register_at_fork(after_in_child=registry.reset)
+
+# Web server
+http_request_duration = registry.histogram(
+    'podcast_http_request_duration_seconds',
+    'Duration of HTTP requests by route',
+    ('route', 'method', 'status'))
+
+# Opencast
+opencast_request_duration = registry.histogram(
+    'podcast_opencast_request_duration_seconds',
+    'Duration of requests to Opencast by endpoint',
+    ('endpoint',))
+opencast_errors = registry.counter(
+    'podcast_opencast_errors_total',
+    'Number of failed requests to Opencast by endpoint',
+    ('endpoint',))
+
+# Watcher
+watcher_cycle_duration = registry.histogram(
+    'podcast_watcher_cycle_duration_seconds',
+    'Duration of publication checks')
+watcher_pending_episodes = registry.gauge(
+    'podcast_watcher_pending_episodes',
+    'Number of episodes waiting to be published')
+
+# Ingest
+ingest_duration = registry.histogram(
+    'podcast_ingest_duration_seconds',
+    'Duration of ingests into Opencast by result',
+    ('result',), buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800))
+
+# Feeds
+feed_build_duration = registry.histogram(
+    'podcast_feed_build_duration_seconds',
+    'Duration of writing feeds, including their archive pages')
+feed_size = registry.histogram(
+    'podcast_feed_size_bytes',
+    'Size of written feeds, excluding archive pages',
+    buckets=SIZE_BUCKETS)
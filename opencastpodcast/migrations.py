@@ -0,0 +1,246 @@
+# Opencast Podcast Studio
+# Copyright 2023 Osnabrück University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''Versioned migrations of the database schema.
+
+New databases are created from the models and marked as being at the latest
+version. Existing databases are upgraded by applying all migrations newer
+than the latest version recorded in the ``schema_version`` table. Databases
+created before migrations were introduced are at version 0.
+
+To change the schema, update the models and append a migration to
+:data:`MIGRATIONS` which applies the same change to existing databases.
+Migrations must not be changed once they are released and should be safe to
+run on a database which already contains the change.
+
+Commands starting several processes migrate the database once before
+starting them. Instances started at the same time on different hosts may
+still migrate concurrently, which is tolerated.
+'''
+
+import logging
+import random
+import time
+import warnings
+
+from datetime import datetime
+from sqlalchemy import func, inspect, insert, select, text
+from sqlalchemy.exc import IntegrityError, OperationalError, \
+        ProgrammingError, SAWarning
+
+from opencastpodcast.db import Base, Podcast, SchemaVersion
+
+# Logger
+logger = logging.getLogger(__name__)
+
+
+def add_column(connection, table, column):
+    '''Add a column of the models to an existing table unless it exists
+    already. Only nullable columns can be added this way.
+
+    :param connection: Database connection to use
+    :param table: Name of the table
+    :param column: Name of the column
+    '''
+    existing = {c['name'] for c in inspect(connection).get_columns(table)}
+    if column in existing:
+        return
+    logger.info('Adding column %s.%s', table, column)
+    column = Base.metadata.tables[table].columns[column]
+    column_type = column.type.compile(connection.dialect)
+    connection.execute(text(
+        f'ALTER TABLE {table} ADD COLUMN {column.name} {column_type}'))
+
+
+def create_index(connection, name):
+    '''Create an index of the models unless it exists already.
+
+    :param connection: Database connection to use
+    :param name: Name of the index
+    '''
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name == name:
+                logger.info('Creating index %s', name)
+                with warnings.catch_warnings():
+                    # Checking for existing indexes cannot reflect
+                    # expression-based indexes and warns about them
+                    warnings.simplefilter('ignore', SAWarning)
+                    index.create(connection, checkfirst=True)
+                return
+    raise ValueError(f'No index named {name}')
+
+
+def drop_index(connection, name):
+    '''Drop an index unless it does not exist.
+
+    :param connection: Database connection to use
+    :param name: Name of the index
+    '''
+    logger.info('Dropping index %s', name)
+    connection.execute(text(f'DROP INDEX IF EXISTS {name}'))
+
+
+def create_table(connection, name):
+    '''Create a table of the models unless it exists already.
+
+    :param connection: Database connection to use
+    :param name: Name of the table
+    '''
+    Base.metadata.tables[name].create(connection, checkfirst=True)
+
+
+def add_episode_scheduling(connection):
+    '''Add columns for feed paging, publication checks and cached items.
+    '''
+    for table, column in (('podcast', 'page_size'),
+                          ('episode', 'check_attempts'),
+                          ('episode', 'next_check'),
+                          ('episode', 'publication_failed'),
+                          ('episode', 'feed_item')):
+        add_column(connection, table, column)
+
+
+def add_episode_indexes(connection):
+    '''Add indexes for feed and publication check queries.
+    '''
+    create_index(connection, 'ix_episode_podcast_published')
+    create_index(connection, 'ix_episode_pending')
+
+
+def add_podcast_organizational_unit(connection):
+    '''Add organizational units of podcasts and indexes for listing podcasts.
+    '''
+    add_column(connection, 'podcast', 'organizational_unit')
+    create_index(connection, 'ix_podcast_title')
+    create_index(connection, 'ix_podcast_organizational_unit')
+
+
+def add_lease(connection):
+    '''Add leases for electing the instance running the watcher.
+    '''
+    create_table(connection, 'lease')
+
+
+def add_image_variants(connection):
+    '''Add resized variants of podcast and episode images.
+    '''
+    for table in ('podcast', 'episode'):
+        add_column(connection, table, 'image_thumbnail')
+        add_column(connection, table, 'image_cover')
+
+
+def index_podcast_sort_title(connection):
+    '''Index podcasts by their sort title which includes missing titles.
+    '''
+    for name in ('ix_podcast_title', 'ix_podcast_organizational_unit'):
+        drop_index(connection, name)
+        create_index(connection, name)
+
+
+# Migrations in the order they are applied.
+# The version of a migration is its position in this list.
+MIGRATIONS = (
+    add_episode_scheduling,
+    add_episode_indexes,
+    add_podcast_organizational_unit,
+    add_lease,
+    add_image_variants,
+    index_podcast_sort_title,
+)
+
+
+def schema_version(connection):
+    '''Get the version of the schema of a database.
+
+    :param connection: Database connection to use
+    :return: Version of the latest applied migration
+    '''
+    version = select(func.max(SchemaVersion.version))
+    return connection.execute(version).scalar() or 0
+
+
+def record_version(engine, version, migration=None):
+    '''Apply a migration and record the new version in one transaction.
+
+    :return: False if another process recorded this version already
+    '''
+    try:
+        with engine.begin() as connection:
+            if migration:
+                migration(connection)
+            connection.execute(insert(SchemaVersion).values(
+                version=version, applied=datetime.now()))
+    except (IntegrityError, OperationalError, ProgrammingError):
+        # Processes migrating at the same time fail to record the same
+        # version or to apply the same schema change
+        with engine.connect() as connection:
+            if schema_version(connection) < version:
+                raise
+        logger.info('Schema version %i was recorded by another process',
+                    version)
+        return False
+    return True
+
+
+def create_tables(engine, attempts=3):
+    '''Create missing tables. Processes creating tables at the same time may
+    fail to create tables which did not exist when they checked. Creating
+    the tables is retried in that case.
+
+    :param engine: SQLAlchemy engine of the database
+    :param attempts: Number of attempts
+    '''
+    for attempt in range(1, attempts + 1):
+        try:
+            Base.metadata.create_all(engine)
+            return
+        except (OperationalError, ProgrammingError) as e:
+            if attempt == attempts:
+                raise
+            logger.info('Tables were created by another process: %s', e)
+            time.sleep(random.uniform(.1, .5))
+
+
+def migrate(engine):
+    '''Create missing tables and apply all pending migrations.
+
+    :param engine: SQLAlchemy engine of the database to migrate
+    :return: Version of the database schema
+    '''
+    latest = len(MIGRATIONS)
+    new = not inspect(engine).has_table(Podcast.__tablename__)
+    create_tables(engine)
+    with engine.connect() as connection:
+        version = schema_version(connection)
+
+    if version > latest:
+        logger.warning('Database schema version %i is newer than the latest '
+                       'known version %i', version, latest)
+        return version
+
+    # New databases are already created with the latest schema
+    if new and not version:
+        logger.info('Created database with schema version %i', latest)
+        record_version(engine, latest)
+        return latest
+
+    for version in range(version + 1, latest + 1):
+        migration = MIGRATIONS[version - 1]
+        logger.info('Migrating database to schema version %i: %s',
+                    version, migration.__doc__.strip())
+        record_version(engine, version, migration)
+    return latest
@@ -0,0 +1,137 @@
+# Opencast Podcast Studio
+# Copyright 2023 Osnabrück University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import os
+import uuid
+
+# Logger
+logger = logging.getLogger(__name__)
+
+
+class MultipartStream:
+    '''File-like object streaming a multipart/form-data request body.
+
+    Files are read from disk in chunks while the body is sent, so memory usage
+    does not depend on the size of the files. Only one file is open at a time
+    and all files are closed once the stream is exhausted or closed.
+
+    Use the stream as context manager to make sure all files get closed::
+
+        with MultipartStream(fields) as body:
+            requests.post(url, data=body, headers=body.headers)
+    '''
+
+    def __init__(self, fields, progress=None):
+        '''Create a new multipart stream.
+
+        :param fields: List of tuples of field name and value. Values are
+                       either strings or tuples of a file name and the path of
+                       the file to send. Fields whose value is None are
+                       left out.
+        :param progress: Optional function called with the number of bytes
+                         sent so far and the total number of bytes
+        '''
+        self.boundary = uuid.uuid4().hex
+        self.progress = progress
+        self.__parts = []
+        for name, value in fields:
+            if value is None:
+                continue
+            if isinstance(value, tuple):
+                filename, path = value
+                header = f'--{self.boundary}\r\n' \
+                    f'Content-Disposition: form-data; name="{name}"; ' \
+                    f'filename="{filename}"\r\n' \
+                    'Content-Type: application/octet-stream\r\n\r\n'
+                self.__parts.append(header.encode('utf-8'))
+                self.__parts.append((path, os.path.getsize(path)))
+                self.__parts.append(b'\r\n')
+            else:
+                part = f'--{self.boundary}\r\n' \
+                    f'Content-Disposition: form-data; name="{name}"\r\n\r\n' \
+                    f'{value}\r\n'
+                self.__parts.append(part.encode('utf-8'))
+        self.__parts.append(f'--{self.boundary}--\r\n'.encode('utf-8'))
+        self.length = sum(len(p) if isinstance(p, bytes) else p[1]
+                          for p in self.__parts)
+        self.sent = 0
+        self.__file = None
+        self.__buffer = b''
+
+    @property
+    def headers(self):
+        '''Headers to send along with the body.
+        '''
+        content_type = f'multipart/form-data; boundary={self.boundary}'
+        return {'Content-Type': content_type,
+                'Content-Length': str(self.length)}
+
+    def __len__(self):
+        return self.length - self.sent
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        '''Close the currently open file, if any, and discard the rest of the
+        stream.
+        '''
+        if self.__file:
+            self.__file.close()
+            self.__file = None
+        self.__parts = []
+        self.__buffer = b''
+
+    def __next_chunk(self, size):
+        # Continue reading the currently open file
+        if self.__file:
+            chunk = self.__file.read(size)
+            if chunk:
+                return chunk
+            self.__file.close()
+            self.__file = None
+        if not self.__parts:
+            return b''
+        part = self.__parts.pop(0)
+        if isinstance(part, bytes):
+            return part
+        self.__file = open(part[0], 'rb')
+        return self.__next_chunk(size)
+
+    def read(self, size=-1):
+        '''Read up to `size` bytes from the stream.
+
+        :param size: Maximum number of bytes to return. If negative, a chunk
+                     of 64 KiB is returned.
+        :return: Bytes of the body or an empty byte string at the end
+        '''
+        size = size if size and size > 0 else 64 * 1024
+        while len(self.__buffer) < size:
+            chunk = self.__next_chunk(size - len(self.__buffer))
+            if not chunk:
+                break
+            self.__buffer += chunk
+        data, self.__buffer = self.__buffer[:size], self.__buffer[size:]
+        self.sent += len(data)
+        if self.progress and data:
+            self.progress(self.sent, self.length)
+        if not data:
+            self.close()
+        return data
@@ -17,10 +17,17 @@
 import requests
 import logging
 import os
+import threading
+import time
 
+from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
 
 from opencastpodcast.config import config
+from opencastpodcast.metrics import opencast_errors, opencast_request_duration
+from opencastpodcast.multipart import MultipartStream
 
 # Public ACL
 acl = '{"acl": {"ace": [' \
@@ -29,6 +36,149 @@ acl = '{"acl": {"ace": [' \
 # Logger
 logger = logging.getLogger(__name__)
 
+# Tolerated difference between the clocks of Opencast and this server
+CLOCK_SKEW = timedelta(minutes=10)
+
+# Client used by the current process. Created on first use.
+__client = None
+__client_lock = threading.Lock()
+
+
+class CircuitOpenError(requests.ConnectionError):
+    '''Raised instead of sending a request while Opencast is considered to be
+    unavailable.
+    '''
+
+
+class OpencastClient:
+    '''Client for the Opencast REST API.
+
+    The client keeps a pool of persistent connections, retries idempotent
+    requests on connection problems and server errors and stops sending
+    requests for a while after repeated failures (circuit breaker).
+    The client is thread-safe.
+    '''
+
+    def __init__(self, server, user, password, timeout=30, retries=3,
+                 pool_size=10, failure_threshold=5, reset_timeout=60):
+        '''Create a new client.
+
+        :param server: Base URL of the Opencast server
+        :param user: User to authenticate as
+        :param password: Password to authenticate with
+        :param timeout: Default timeout in seconds for requests
+        :param retries: Number of retries for idempotent requests
+        :param pool_size: Number of connections to keep open
+        :param failure_threshold: Number of consecutive failures after which
+                                  no requests are sent any longer
+        :param reset_timeout: Seconds after which requests are sent again
+        '''
+        self.server = server.rstrip('/')
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        # Only idempotent requests are retried on read errors and server
+        # errors. Requests which could not connect are always retried.
+        retry = Retry(total=retries,
+                      backoff_factor=0.5,
+                      status_forcelist=(502, 503, 504),
+                      allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.auth = HTTPBasicAuth(user, password)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.__lock = threading.Lock()
+        self.__failures = 0
+        self.__opened = None
+
+    def available(self):
+        '''Check if requests are currently sent to Opencast.
+
+        :return: False if the circuit breaker is open
+        '''
+        with self.__lock:
+            return self.__opened is None \
+                or time.monotonic() - self.__opened >= self.reset_timeout
+
+    def __record(self, endpoint, duration, error=False, failure=False):
+        opencast_request_duration.observe(duration, endpoint=endpoint)
+        if error:
+            opencast_errors.inc(endpoint=endpoint)
+        with self.__lock:
+            if not failure:
+                self.__failures = 0
+                self.__opened = None
+                return
+            self.__failures += 1
+            if self.__failures >= self.failure_threshold:
+                if self.__opened is None:
+                    logger.warning('Opencast seems to be unavailable. Pausing '
+                                   'requests for %i seconds',
+                                   self.reset_timeout)
+                self.__opened = time.monotonic()
+
+    def request(self, method, path, **kwargs):
+        '''Send a request to Opencast.
+
+        :param method: HTTP method to use
+        :param path: Path of the endpoint, including a leading slash
+        :param kwargs: Additional arguments passed on to requests
+        :return: The response
+        :raises CircuitOpenError: If Opencast is considered to be unavailable
+        :raises requests.RequestException: If the request failed
+        '''
+        if not self.available():
+            raise CircuitOpenError(f'Opencast unavailable. Skipping {path}')
+        kwargs.setdefault('timeout', self.timeout)
+        start = time.monotonic()
+        try:
+            r = self.session.request(method, f'{self.server}{path}', **kwargs)
+            r.raise_for_status()
+        except requests.RequestException as e:
+            # Client errors do not mean that Opencast is unavailable
+            response = getattr(e, 'response', None)
+            failure = response is None or response.status_code >= 500
+            self.__record(path, time.monotonic() - start, True, failure)
+            raise
+        self.__record(path, time.monotonic() - start)
+        return r
+
+
+def setting(key, default):
+    '''Get a numeric Opencast setting for which 0 is a meaningful value.
+
+    :param key: Key of the setting in the `opencast` section
+    :param default: Value to use if the setting is not configured
+    '''
+    value = config('opencast', key)
+    return default if value is None else value
+
+
+def client():
+    '''Get the Opencast client of the current process, creating it based on
+    the configuration if necessary.
+
+    :return: OpencastClient
+    '''
+    global __client
+    with __client_lock:
+        # Connections must not be shared with forked processes
+        if not __client or __client[0] != os.getpid():
+            __client = (os.getpid(), OpencastClient(
+                config('opencast', 'server'),
+                config('opencast', 'user'),
+                config('opencast', 'password'),
+                timeout=config('opencast', 'timeout') or 30,
+                retries=setting('retries', 3),
+                pool_size=config('opencast', 'pool_size') or 10,
+                failure_threshold=config('opencast', 'failure_threshold') or 5,
+                reset_timeout=setting('reset_timeout', 60)))
+        return __client[1]
+
 
 def ensure_list(elem):
     if type(elem) is list:
@@ -36,23 +186,12 @@ def ensure_list(elem):
     return [elem]
 
 
-def auth():
-    user = config('opencast', 'user')
-    password = config('opencast', 'password')
-    return HTTPBasicAuth(user, password)
-
-
 def post(path, **kwargs):
-    server = config('opencast', 'server')
-    r = requests.post(f'{server}{path}', auth=auth(), **kwargs)
-    r.raise_for_status()
+    client().request('POST', path, **kwargs)
 
 
 def get(path, **kwargs):
-    server = config('opencast', 'server')
-    r = requests.get(f'{server}{path}', auth=auth(), **kwargs)
-    r.raise_for_status()
-    return r.json()
+    return client().request('GET', path, **kwargs).json()
 
 
 def create_series(podcast):
@@ -74,26 +213,42 @@ def create_episode(episode):
     media = os.path.join(upload_tmp_dir, episode.media)
 
     # Build request
-    fields = [('acl', (None, acl))]
-    fields.append(('identifier', (None, episode.episode_id)))
-    fields.append(('title', (None, episode.title)))
-    fields.append(('publisher', (None, episode.author)))
-    fields.append(('isPartOf', (None, episode.podcast_id)))
-    fields.append(('flavor', (None, 'presenter/source')))
-    fields.append(('BODY', open(image, 'rb')))
-    fields.append(('flavor', (None, 'presenter/source')))
-    fields.append(('BODY', open(media, 'rb')))
+    fields = [('acl', acl)]
+    fields.append(('identifier', episode.episode_id))
+    fields.append(('title', episode.title))
+    fields.append(('publisher', episode.author))
+    fields.append(('isPartOf', episode.podcast_id))
+    fields.append(('flavor', 'presenter/source'))
+    fields.append(('BODY', (os.path.basename(image), image)))
+    fields.append(('flavor', 'presenter/source'))
+    fields.append(('BODY', (os.path.basename(media), media)))
 
-    # Ingest media
-    post(f'/ingest/addMediaPackage/{workflow}', files=fields)
+    # Log progress in steps of ten percent
+    logged = 0
 
+    def progress(sent, total):
+        nonlocal logged
+        percent = sent * 100 // total
+        if percent >= logged + 10:
+            logged = percent - percent % 10
+            logger.info('Episode %s: Ingested %i%% of %i bytes',
+                        episode.episode_id, logged, total)
 
-def get_episode_url(episode_id):
-    episode = get('/search/episode.json', params={'id': episode_id})
-    episode = episode.get('search-results').get('result')
-    if not episode:
-        return None
-    mediapackage = episode.get('mediapackage')
+    # Ingest media, streaming the files from disk
+    timeout = config('opencast', 'ingest_timeout') or 300
+    with MultipartStream(fields, progress) as body:
+        post(f'/ingest/addMediaPackage/{workflow}',
+             data=body,
+             headers=body.headers,
+             timeout=timeout)
+
+
+def get_track(mediapackage):
+    '''Get the podcast audio track from a published media package.
+
+    :param mediapackage: Media package as returned by the search service
+    :return: Dictionary with track url, duration and size or None
+    '''
     tracks = ensure_list(mediapackage.get('media').get('track'))
     for track in tracks:
         if track.get('type') == 'presenter/audio':
@@ -101,3 +256,69 @@ def get_episode_url(episode_id):
                     'duration': track.get('duration'),
                     'size': track.get('size')}
 
+
+def get_episode_url(episode_id):
+    episode = get('/search/episode.json', params={'id': episode_id})
+    episode = episode.get('search-results').get('result')
+    if not episode:
+        return None
+    return get_track(episode.get('mediapackage'))
+
+
+def parse_date(value):
+    '''Parse a date returned by Opencast.
+
+    :param value: Date in ISO 8601 format
+    :return: Timezone aware datetime or None if the date is invalid
+    '''
+    try:
+        date = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    return date if date.tzinfo else date.astimezone()
+
+
+def get_series_episode_urls(series_id, episode_ids, since=None):
+    '''Look up the publications of several episodes of one series using
+    series-scoped search requests instead of one request per episode.
+
+    Episodes are requested in the order they were published, newest first.
+    Episodes cannot be published before they were uploaded, so paging stops
+    at episodes published before the oldest wanted episode was uploaded.
+
+    :param series_id: Identifier of the series the episodes belong to
+    :param episode_ids: Identifiers of the episodes to look for
+    :param since: Upload time of the oldest wanted episode
+    :return: Dictionary mapping episode identifiers to their tracks
+    '''
+    wanted = set(episode_ids)
+    tracks = {}
+    limit = config('watcher', 'search_limit') or 100
+    if since:
+        since = since.astimezone() - CLOCK_SKEW
+    offset = 0
+    while wanted:
+        params = {'sid': series_id, 'limit': limit, 'offset': offset,
+                  'sort': 'DATE_PUBLISHED_DESC'}
+        result = get('/search/episode.json', params=params)
+        result = result.get('search-results')
+        episodes = ensure_list(result.get('result') or [])
+        for episode in episodes:
+            mediapackage = episode.get('mediapackage')
+            identifier = mediapackage.get('id')
+            if identifier not in wanted:
+                continue
+            track = get_track(mediapackage)
+            if track:
+                tracks[identifier] = track
+                wanted.discard(identifier)
+        offset += limit
+        if len(episodes) < limit or offset >= int(result.get('total') or 0):
+            break
+        # Only trust the dates if Opencast actually sorted the results
+        dates = [parse_date(episode.get('modified')) for episode in episodes]
+        if since and None not in dates \
+                and dates == sorted(dates, reverse=True) \
+                and dates[-1] < since:
+            break
+    return tracks
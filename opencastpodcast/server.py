@@ -0,0 +1,143 @@
+# Opencast Podcast Studio
+# Copyright 2023 Osnabrück University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''Production web server based on Gunicorn.
+
+The Gunicorn arbiter forks a configurable number of worker processes serving
+the web application and runs the supervisor of the watcher and the ingest
+workers in a separate process started with the ``services`` command.
+Sending ``SIGHUP`` reloads the configuration, gracefully replaces the web
+server workers and restarts the supervised services. Sending ``SIGTERM``
+stops all processes gracefully.
+'''
+
+import logging
+import multiprocessing
+import subprocess
+import sys
+
+from opencastpodcast.config import config, update_configuration
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    BaseApplication = None
+
+# Logger
+logger = logging.getLogger(__name__)
+
+
+def server_options(workers=None, bind=None):
+    '''Get the Gunicorn settings from the configuration.
+
+    :param workers: Number of workers overriding the configuration
+    :param bind: Address to listen on overriding the configuration
+    :return: Dictionary of Gunicorn settings
+    '''
+    server = config('server') or {}
+    return {
+        'bind': bind or server.get('bind') or '127.0.0.1:5000',
+        'workers': workers or server.get('workers')
+        or multiprocessing.cpu_count() * 2 + 1,
+        'timeout': server.get('timeout') or 30,
+        'graceful_timeout': server.get('graceful_timeout') or 30,
+        # Load the application in every worker so that reloading the
+        # configuration also applies to the web application
+        'preload_app': False,
+    }
+
+
+def start_services(config_file, timeout):
+    '''Start the supervisor of the background services. It is started as a
+    new program so that it shares no state with the web server workers.
+
+    :param config_file: Configuration file to use
+    :param timeout: Seconds services get to finish when stopping
+    :return: Process of the supervisor
+    '''
+    command = [sys.executable, '-m', 'opencastpodcast']
+    if config_file:
+        command += ['--config', config_file]
+    command += ['services', '--timeout', str(timeout)]
+    return subprocess.Popen(command)
+
+
+def stop_services(supervisor, timeout):
+    '''Stop the supervisor of the background services.
+
+    :param supervisor: Process of the supervisor
+    :param timeout: Seconds services get to finish when stopping
+    '''
+    supervisor.terminate()
+    try:
+        # Give the supervisor time to kill services which did not exit
+        supervisor.wait(timeout + 5)
+    except subprocess.TimeoutExpired:
+        logger.warning('Killing supervisor')
+        supervisor.kill()
+        supervisor.wait()
+
+
+def run_server(config_file=None, workers=None, bind=None):
+    '''Run the web application with Gunicorn next to the supervised
+    background services.
+
+    :param config_file: Configuration file to read when reloading
+    :param workers: Number of workers overriding the configuration
+    :param bind: Address to listen on overriding the configuration
+    '''
+    if BaseApplication is None:
+        raise RuntimeError('The Python module `gunicorn` is required to run '
+                           'the production web server')
+
+    class Application(BaseApplication):
+
+        supervisor = None
+
+        def load_config(self):
+            # Called on start and again when reloading
+            if self.supervisor:
+                update_configuration(config_file)
+            for key, value in server_options(workers, bind).items():
+                self.cfg.set(key, value)
+            self.cfg.set('when_ready', self.when_ready)
+            self.cfg.set('on_reload', self.on_reload)
+            self.cfg.set('on_exit', self.on_exit)
+
+        def load(self):
+            from opencastpodcast.web import app
+            return app
+
+        def stop_timeout(self):
+            return self.cfg.graceful_timeout
+
+        def when_ready(self, server):
+            Application.supervisor = start_services(
+                config_file, self.stop_timeout())
+
+        def on_reload(self, server):
+            logger.info('Restarting services')
+            if self.supervisor:
+                stop_services(self.supervisor, self.stop_timeout())
+            Application.supervisor = start_services(
+                config_file, self.stop_timeout())
+
+        def on_exit(self, server):
+            # The arbiter may exit before the services were started
+            if self.supervisor:
+                stop_services(self.supervisor, self.stop_timeout())
+
+    Application().run()
@@ -1,13 +1,3 @@
-var zipcodes = {};
-
-function loadZipCodes() {
-  fetch("/static/zipcodes.json")
-    .then((response) => response.json())
-    .then((codes) => {
-      zipcodes = codes;
-    });
-}
-
 function validateLogin() {
   const login = document.querySelector("input[name=login]");
   if (login.value.length < 4) {
@@ -83,10 +73,16 @@ function validatePassword() {
 function updateCity(post_code_field, ciry_field) {
   const post_code = document.querySelector(`input[name=${post_code_field}]`);
   const city = document.querySelector(`input[name=${ciry_field}]`);
-  const name = zipcodes[post_code.value];
-  if (name && city) {
-    city.value = name;
+  if (!city || !/^[0-9]{5}$/.test(post_code.value)) {
+    return;
   }
+  fetch("/api/zipcode/" + post_code.value)
+    .then((response) => response.json())
+    .then((zipcode) => {
+      if (zipcode.city) {
+        city.value = zipcode.city;
+      }
+    });
 }
 
 function updateWorkCity() {
@@ -147,7 +143,4 @@ addEventListener("DOMContentLoaded", () => {
     "input[name=private_post_code]",
   );
   private_post_code?.addEventListener("change", updatePrivateCity);
-  if (work_post_code || private_post_code) {
-    loadZipCodes();
-  }
 });
@@ -0,0 +1,141 @@
+const statusText = {
+  pending: "Waiting for upload to Opencast…",
+  running: "Uploading to Opencast…",
+  failed: "Upload to Opencast failed",
+  done: "Processing in Opencast…",
+};
+
+function updateStatus(elem) {
+  fetch(elem.getAttribute("data-status"))
+    .then((response) => response.json())
+    .then((status) => {
+      if (status.published) {
+        window.location.reload();
+        return;
+      }
+      if (status.publication_failed) {
+        elem.innerText = "Publication failed";
+        return;
+      }
+      const ingest = status.ingest?.status || "done";
+      elem.innerText = statusText[ingest];
+      if (ingest === "failed") {
+        elem.title = status.ingest.error;
+        return;
+      }
+      setTimeout(() => updateStatus(elem), 5000);
+    });
+}
+
+addEventListener("DOMContentLoaded", () => {
+  for (let elem of document.querySelectorAll("*[data-status]")) {
+    updateStatus(elem);
+  }
+});
+
+// Resumable chunked media upload
+const chunkSize = 8 * 1024 * 1024;
+
+function sleep(ms) {
+  return new Promise((resolve) => setTimeout(resolve, ms));
+}
+
+async function chunkChecksum(chunk) {
+  if (!window.crypto?.subtle) {
+    return null;
+  }
+  const digest = await crypto.subtle.digest("SHA-256", await chunk.arrayBuffer());
+  return "sha256 " + btoa(String.fromCharCode(...new Uint8Array(digest)));
+}
+
+async function currentOffset(url) {
+  const response = await fetch(url, { method: "HEAD" });
+  return parseInt(response.headers.get("Upload-Offset"));
+}
+
+async function uploadMedia(podcastUrl, file, onProgress) {
+  const response = await fetch(podcastUrl + "/upload", {
+    method: "POST",
+    headers: {
+      "Upload-Length": file.size,
+      "Upload-Filename": encodeURIComponent(file.name),
+    },
+  });
+  if (!response.ok) {
+    throw new Error(await response.text());
+  }
+  const url = response.headers.get("Location");
+  const upload = await response.json();
+
+  let offset = 0;
+  let failures = 0;
+  while (offset < file.size) {
+    const chunk = file.slice(offset, offset + chunkSize);
+    const headers = {
+      "Content-Type": "application/offset+octet-stream",
+      "Upload-Offset": offset,
+    };
+    const checksum = await chunkChecksum(chunk);
+    if (checksum) {
+      headers["Upload-Checksum"] = checksum;
+    }
+    try {
+      const response = await fetch(url, {
+        method: "PATCH",
+        headers: headers,
+        body: chunk,
+      });
+      if (!response.ok && ![409, 460].includes(response.status)) {
+        throw new Error(await response.text());
+      }
+      offset = parseInt(response.headers.get("Upload-Offset"));
+      failures = 0;
+    } catch (error) {
+      // Wait and resume from where the server is
+      if (++failures > 10) {
+        throw error;
+      }
+      console.warn(`Upload failed, retrying: ${error}`);
+      await sleep(1000 * Math.min(2 ** failures, 30));
+      offset = await currentOffset(url).catch(() => offset);
+    }
+    onProgress(offset, file.size);
+  }
+  return upload.upload_id;
+}
+
+async function submitEpisode(event) {
+  const form = event.target;
+  const media = form.querySelector("input[name=media]");
+  if (!media?.files.length || !window.fetch) {
+    return;
+  }
+  event.preventDefault();
+  const button = form.querySelector("button[type=submit]");
+  button.disabled = true;
+  try {
+    const upload = await uploadMedia(
+      form.getAttribute("action"),
+      media.files[0],
+      (offset, size) => {
+        button.innerText = `Uploading… ${Math.floor((offset * 100) / size)}%`;
+      },
+    );
+    const data = new FormData(form);
+    data.delete("media");
+    data.set("upload", upload);
+    const response = await fetch(form.getAttribute("action"), {
+      method: "POST",
+      body: data,
+    });
+    window.location = response.url;
+  } catch (error) {
+    button.disabled = false;
+    button.innerText = `Upload failed: ${error.message}`;
+  }
+}
+
+addEventListener("DOMContentLoaded", () => {
+  const form = document.querySelector("form[data-resumable]");
+  form?.addEventListener("submit", submitEpisode);
+});
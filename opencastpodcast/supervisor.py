@@ -0,0 +1,178 @@
+# Opencast Podcast Studio
+# Copyright 2023 Osnabrück University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''Supervision of the background services running next to the web server.
+
+The supervisor runs in its own process and starts every service in a child
+process. Services which exit or crash are restarted with a growing delay.
+Stopping the supervisor terminates all services and gives them time to shut
+down gracefully, e.g. to release their leases.
+'''
+
+import logging
+import signal
+import sys
+import time
+
+from multiprocessing import Process
+
+from opencastpodcast.ingest import run_ingest
+from opencastpodcast.watcher import run_watcher
+
+# Logger
+logger = logging.getLogger(__name__)
+
+# Services started by the supervisor
+SERVICES = {
+    'watcher': run_watcher,
+    'ingest': run_ingest,
+}
+
+# Maximum delay in seconds before restarting a failed service
+MAX_RESTART_DELAY = 60
+
+# Services running this many seconds are considered to have started
+# successfully and failures start again with the shortest delay
+STABLE_RUNTIME = 60
+
+
+def exit_on_signal(signum, frame):
+    sys.exit(0)
+
+
+def run_service(name, target):
+    '''Run a service in a child process of the supervisor.
+
+    Terminating the service raises :class:`SystemExit`, so that the service
+    can clean up. Interrupts from the terminal are left to the supervisor.
+
+    :param name: Name of the service
+    :param target: Function running the service
+    '''
+    signal.signal(signal.SIGTERM, exit_on_signal)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logger.info('Starting %s', name)
+    target()
+
+
+class Supervisor:
+    '''Supervisor starting services and restarting them if they exit.
+    '''
+
+    def __init__(self, services):
+        self.services = services
+        self.processes = {}
+        self.failures = {name: 0 for name in services}
+        self.restart_at = {name: 0 for name in services}
+        self.started = {}
+        self.stopping = False
+
+    def start(self, name):
+        process = Process(target=run_service, name=name,
+                          args=(name, self.services[name]))
+        process.start()
+        self.processes[name] = process
+        self.started[name] = time.monotonic()
+
+    def check(self):
+        '''Start services which are not running and are due to be started.
+        '''
+        now = time.monotonic()
+        for name in self.services:
+            process = self.processes.get(name)
+            if process and process.is_alive():
+                continue
+            if process:
+                # Schedule restart of the exited service
+                process.join()
+                del self.processes[name]
+                if now - self.started[name] >= STABLE_RUNTIME:
+                    self.failures[name] = 0
+                delay = min(2 ** self.failures[name], MAX_RESTART_DELAY)
+                self.failures[name] += 1
+                self.restart_at[name] = now + delay
+                logger.error('Service %s exited with code %s. Restarting '
+                             'in %i seconds', name, process.exitcode, delay)
+            if now >= self.restart_at[name]:
+                self.start(name)
+
+    def stop(self, timeout):
+        '''Terminate all services and wait for them to exit. Services still
+        running after the timeout are killed.
+
+        :param timeout: Seconds to wait for services to exit
+        '''
+        for process in self.processes.values():
+            process.terminate()
+        deadline = time.monotonic() + timeout
+        for name, process in self.processes.items():
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logger.warning('Killing service %s', name)
+                process.kill()
+                process.join()
+        self.processes = {}
+
+    def handle_signal(self, signum, frame):
+        self.stopping = True
+
+    def run(self, timeout):
+        '''Supervise the services until the process is terminated.
+
+        :param timeout: Seconds to wait for services to exit when stopping
+        '''
+        signal.signal(signal.SIGTERM, self.handle_signal)
+        signal.signal(signal.SIGINT, self.handle_signal)
+        while not self.stopping:
+            self.check()
+            time.sleep(1)
+        logger.info('Stopping services')
+        self.stop(timeout)
+
+
+def supervise(timeout):
+    '''Run and supervise all services.
+
+    :param timeout: Seconds to wait for services to exit when stopping
+    '''
+    Supervisor(SERVICES).run(timeout)
+
+
+def start_supervisor(timeout=30):
+    '''Start the supervisor in a new process.
+
+    :param timeout: Seconds to wait for services to exit when stopping
+    :return: Process of the supervisor
+    '''
+    supervisor = Process(target=supervise, name='supervisor',
+                         args=(timeout,))
+    supervisor.start()
+    return supervisor
+
+
+def stop_supervisor(supervisor, timeout=30):
+    '''Stop the supervisor and all services.
+
+    :param supervisor: Process of the supervisor
+    :param timeout: Seconds the supervisor waits for services to exit
+    '''
+    supervisor.terminate()
+    # Give the supervisor time to kill services which did not exit
+    supervisor.join(timeout + 5)
+    if supervisor.is_alive():
+        logger.warning('Killing supervisor')
+        supervisor.kill()
+        supervisor.join()
@@ -0,0 +1,251 @@
+# Opencast Podcast Studio
+# Copyright 2023 Osnabrück University
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import base64
+import fcntl
+import hashlib
+import logging
+import os
+import uuid
+
+from datetime import datetime, timedelta
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from opencastpodcast.config import config
+from opencastpodcast.db import get_session, Upload
+
+# Logger
+logger = logging.getLogger(__name__)
+
+# Size of blocks read from the request while writing chunks
+BLOCK_SIZE = 64 * 1024
+
+
+class UploadError(Exception):
+    '''Error while handling a resumable upload.
+    '''
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def upload_path(upload):
+    '''Get the path of the temporary file of an upload.
+    '''
+    upload_tmp_dir = config('directories', 'upload_tmp') or 'upload_tmp'
+    return os.path.join(upload_tmp_dir, f'{upload.upload_id}.part')
+
+
+def parse_checksum(checksum):
+    '''Parse a checksum of the form ``<algorithm> <base64 digest>`` as used by
+    the tus checksum extension.
+
+    :param checksum: Checksum string or None
+    :return: Tuple of hash object and expected digest or None
+    '''
+    if not checksum:
+        return None
+    try:
+        algorithm, digest = checksum.split(' ', 1)
+        digest = base64.b64decode(digest, validate=True)
+    except ValueError:
+        raise UploadError('Invalid checksum')
+    if algorithm not in ('sha1', 'sha256', 'sha512'):
+        raise UploadError('Unsupported checksum algorithm')
+    return hashlib.new(algorithm), digest
+
+
+def create_upload(db, podcast_id, filename, length, checksum=None):
+    '''Create a new resumable upload.
+
+    :param db: Database session to use
+    :param podcast_id: Identifier of the podcast the media belongs to
+    :param filename: Original name of the file to upload
+    :param length: Size of the file in bytes
+    :param checksum: Optional checksum of the whole file
+    :return: The new upload
+    '''
+    extension = (filename or '').lower().split('.')[-1]
+    if extension not in ('mp3', 'm4a'):
+        raise UploadError('Invalid media type')
+    if length <= 0:
+        raise UploadError('Invalid upload length')
+    parse_checksum(checksum)
+
+    upload = Upload(upload_id=str(uuid.uuid4()),
+                    podcast_id=podcast_id,
+                    extension=extension,
+                    length=length,
+                    offset=0,
+                    checksum=checksum)
+    # Create an empty file chunks can be written to
+    with open(upload_path(upload), 'wb'):
+        pass
+    db.add(upload)
+    db.commit()
+    logger.info('Created upload %s of %i bytes', upload.upload_id, length)
+    return upload
+
+
+def verify(upload):
+    '''Verify the checksum of a completed upload.
+
+    :param upload: Upload to verify
+    :return: If no checksum was specified or the checksum matches
+    '''
+    checksum = parse_checksum(upload.checksum)
+    if not checksum:
+        return True
+    hasher, digest = checksum
+    with open(upload_path(upload), 'rb') as f:
+        while block := f.read(BLOCK_SIZE):
+            hasher.update(block)
+    return hasher.digest() == digest
+
+
+def write_chunk(db, upload, offset, stream, checksum=None):
+    '''Write a chunk of data to its offset in the upload.
+
+    If a checksum is given, the offset is only advanced if the chunk matches
+    the checksum. Once the upload is complete, the checksum of the whole file
+    is verified. If this fails, the upload starts from the beginning.
+    Only one request at a time may write to an upload.
+
+    :param db: Database session to use
+    :param upload: Upload to write the chunk to
+    :param offset: Offset the chunk starts at
+    :param stream: File-like object to read the chunk from
+    :param checksum: Optional checksum of the chunk
+    :return: The new offset of the upload
+    '''
+    checksum = parse_checksum(checksum)
+    with open(upload_path(upload), 'r+b') as f:
+        # Lock the file before writing so that concurrent requests for the
+        # same offset cannot interleave their data
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise UploadError('Upload is in use', 409)
+        # Another request may have advanced the offset before we got the lock
+        db.refresh(upload)
+        if offset != upload.offset:
+            raise UploadError('Offset mismatch', 409)
+
+        written = 0
+        remaining = upload.length - offset
+        f.seek(offset)
+        while block := stream.read(BLOCK_SIZE):
+            if written + len(block) > remaining:
+                raise UploadError('Chunk exceeds upload length', 413)
+            f.write(block)
+            if checksum:
+                checksum[0].update(block)
+            written += len(block)
+        f.flush()
+
+        if checksum and checksum[0].digest() != checksum[1]:
+            raise UploadError('Checksum mismatch', 460)
+
+        # Advance offset unless another instance interfered
+        updated = db.query(Upload)\
+            .where(Upload.upload_id == upload.upload_id)\
+            .where(Upload.offset == offset)\
+            .update({Upload.offset: offset + written})
+        db.commit()
+        db.refresh(upload)
+        if not updated:
+            raise UploadError('Offset mismatch', 409)
+
+        if upload.offset == upload.length and not verify(upload):
+            logger.warning('Checksum mismatch for upload %s',
+                           upload.upload_id)
+            upload.offset = 0
+            db.commit()
+            raise UploadError('Checksum mismatch', 460)
+        return upload.offset
+
+
+def take_upload(db, upload_id, podcast_id, filename):
+    '''Move the file of a completed upload to its final location in the
+    temporary upload directory and remove the upload.
+
+    The file is linked to its final location right away but its old name is
+    only removed once the session is committed. If the session is rolled
+    back instead, the new name is removed and the upload can be used again.
+
+    :param db: Database session to use
+    :param upload_id: Identifier of the upload
+    :param podcast_id: Identifier of the podcast the upload must belong to
+    :param filename: Name of the media file without extension
+    :return: Name of the media file including its extension
+    '''
+    upload = db.get(Upload, upload_id)
+    if not upload or upload.podcast_id != podcast_id:
+        raise UploadError('No such upload', 404)
+    if upload.offset != upload.length:
+        raise UploadError('Upload is incomplete', 409)
+    filename = f'{filename}.{upload.extension}'
+    upload_tmp_dir = config('directories', 'upload_tmp') or 'upload_tmp'
+    source = upload_path(upload)
+    target = os.path.join(upload_tmp_dir, filename)
+    os.link(source, target)
+    db.delete(upload)
+    db.info.setdefault('taken_uploads', []).append((source, target))
+    return filename
+
+
+@event.listens_for(Session, 'after_commit')
+def remove_taken_uploads(session):
+    '''Remove the old names of the files of uploads taken by a committed
+    session.
+    '''
+    for source, _ in session.info.pop('taken_uploads', ()):
+        remove(source)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def restore_taken_uploads(session, previous_transaction):
+    '''Remove the new names of the files of uploads taken by a session
+    which was rolled back.
+    '''
+    for _, target in session.info.pop('taken_uploads', ()):
+        remove(target)
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def expire_uploads():
+    '''Remove uploads which were not completed in time.
+    '''
+    max_age = config('upload', 'max_age') or 24 * 3600
+    db = get_session()
+    expired = datetime.now() - timedelta(seconds=max_age)
+    for upload in db.query(Upload).where(Upload.created < expired):
+        logger.info('Removing expired upload %s', upload.upload_id)
+        try:
+            os.remove(upload_path(upload))
+        except FileNotFoundError:
+            pass
+        db.delete(upload)
+    db.commit()
+    db.close()
@@ -15,38 +15,231 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import logging
+import random
+import threading
 import time
 
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from sqlalchemy import exists, func, or_
+
 from opencastpodcast.config import config
-from opencastpodcast.db import get_session, Podcast, Episode
-from opencastpodcast.opencast import get_episode_url
-from opencastpodcast.feed import update_feed
+from opencastpodcast.db import get_session, Podcast, Episode, IngestJob, \
+        JobStatus
+from opencastpodcast.opencast import client, get_episode_url, \
+        get_series_episode_urls
+from opencastpodcast.feed import process_feed_updates, request_feed_update
+from opencastpodcast.lease import acquire_lease, holder_id, release_lease
+from opencastpodcast.metrics import registry, watcher_cycle_duration, \
+        watcher_pending_episodes
+from opencastpodcast.upload import expire_uploads
 
 
 # Logger
 logger = logging.getLogger(__name__)
 
+def lookup(podcast_id, episode_ids, since=None):
+    '''Look up the publications of pending episodes of one podcast.
+
+    Several episodes are resolved using series-scoped search requests while a
+    single episode is looked up directly.
+    This function does not touch the database and is safe to be run in
+    worker threads.
+
+    :param podcast_id: Identifier of the podcast (Opencast series)
+    :param episode_ids: Identifiers of pending episodes of this podcast
+    :param since: Upload time of the oldest of these episodes
+    :return: Dictionary mapping episode identifiers to tracks
+    '''
+    if len(episode_ids) > 1:
+        logger.info('Podcast %s: Checking publication of %i episodes',
+                    podcast_id, len(episode_ids))
+        return get_series_episode_urls(podcast_id, episode_ids, since)
+
+    episode_id = episode_ids[0]
+    logger.info('Episode %s: Checking publication', episode_id)
+    track = get_episode_url(episode_id)
+    return {episode_id: track} if track else {}
+
+
+def lookup_tasks(episodes):
+    '''Split pending episodes into independent lookup tasks.
+
+    If batching is enabled, there is one task per podcast. Otherwise, there is
+    one task per episode.
+
+    :param episodes: List of pending episodes
+    :return: List of tuples of podcast identifier, episode identifiers and
+             the upload time of the oldest of these episodes
+    '''
+    pending = defaultdict(list)
+    for episode in episodes:
+        pending[episode.podcast_id].append(episode)
+
+    if config('watcher', 'batch') is False:
+        return [(episode.podcast_id, [episode.episode_id], episode.published)
+                for episodes in pending.values()
+                for episode in episodes]
+    return [(podcast_id, [episode.episode_id for episode in episodes],
+             min((e.published for e in episodes if e.published),
+                 default=None))
+            for podcast_id, episodes in pending.items()]
+
+
+def schedule(episode, now):
+    '''Schedule the next publication check of an episode which is not yet
+    published, backing off exponentially with every failed attempt. If
+    Opencast sends publication notifications, checks start with a longer
+    interval.
+    Episodes older than the configured maximum age are flagged as failed and
+    are not checked any longer.
+
+    :param episode: Episode to schedule the next check for
+    :param now: Current time
+    '''
+    max_age = config('watcher', 'max_age') or 7 * 24 * 3600
+    if episode.published and now - episode.published \
+            > timedelta(seconds=max_age):
+        logger.warning('Episode %s: Giving up on publication after %i checks',
+                       episode.episode_id, episode.check_attempts or 0)
+        episode.publication_failed = True
+        episode.next_check = None
+        return
+
+    interval = config('watcher', 'interval') or 10
+    if config('opencast', 'notify_token'):
+        # Opencast notifies us about publications. Polling is only a fallback.
+        interval = config('watcher', 'notify_interval') or 300
+    max_interval = config('watcher', 'max_interval') or 1800
+    attempts = (episode.check_attempts or 0) + 1
+    delay = min(max_interval, interval * 2 ** min(attempts - 1, 32))
+    # Add jitter so that episodes uploaded together spread out over time
+    delay = delay / 2 + random.uniform(0, delay / 2)
+    episode.check_attempts = attempts
+    episode.next_check = now + timedelta(seconds=delay)
+    logger.debug('Episode %s: Next check in %i seconds',
+                 episode.episode_id, delay)
+
+
+def pending_episodes(session):
+    '''Get a query for all episodes waiting to be published.
+    Episodes which are not yet ingested into Opencast are skipped.
+    '''
+    ingesting = exists()\
+        .where(IngestJob.episode_id == Episode.episode_id)\
+        .where(IngestJob.status != JobStatus.done)
+    return session.query(Episode)\
+        .where(Episode.media_url == None)\
+        .where(Episode.publication_failed.is_not(True))\
+        .where(~ingesting)
+
+
 def check():
+    '''Check all episodes which are due for a publication check.
+
+    :return: Time of the next due check or None if nothing is pending
+    '''
+    if not client().available():
+        logger.info('Opencast is unavailable. Pausing publication checks')
+        return None
+
+    start = time.perf_counter()
     session = get_session()
-    episodes = session.query(Episode).where(Episode.media_url == None).all()
-    for episode in episodes:
-        logger.info('Episode %s: Checking publication', episode.episode_id)
-        track = get_episode_url(episode.episode_id)
-        if track:
-            logger.info('Found %s', track['url'])
-            episode.media_url = track.get('url')
-            episode.media_size = track.get('size')
-            episode.media_duration = track.get('duration')
+    now = datetime.now()
+    episodes = pending_episodes(session)\
+        .where(or_(Episode.next_check == None, Episode.next_check <= now))\
+        .all()
+    episodes = {episode.episode_id: episode for episode in episodes}
+
+    # Query Opencast concurrently but write results to the database from this
+    # thread only.
+    workers = config('watcher', 'concurrency') or 4
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(lookup, *task): task[0]
+                   for task in lookup_tasks(episodes.values())}
+        for future in as_completed(futures):
+            try:
+                tracks = future.result()
+            except Exception as e:
+                logger.warning('Podcast %s: Checking publication failed: %s',
+                               futures[future], e)
+                continue
+            for episode_id, track in tracks.items():
+                episode = episodes.pop(episode_id)
+                logger.info('Found %s', track['url'])
+                episode.media_url = track.get('url')
+                episode.media_size = track.get('size')
+                episode.media_duration = track.get('duration')
+                episode.next_check = None
+                episode.publication_failed = False
+                request_feed_update(session, episode.podcast_id)
             session.commit()
-            update_feed(episode.podcast_id)
+
+    # Back off on all episodes which are still not published
+    for episode in episodes.values():
+        schedule(episode, now)
+    session.commit()
+
+    next_check, pending = pending_episodes(session)\
+        .with_entities(func.min(Episode.next_check), func.count())\
+        .one()
     session.close()
+    watcher_pending_episodes.set(pending)
+    watcher_cycle_duration.observe(time.perf_counter() - start)
+    return next_check
 
 
-def run_watcher():
+def watch():
+    '''Check for publications and build feeds until the process is
+    terminated.
+    '''
+    # Sleep until the next check or feed update is due but wake up regularly
+    # to pick up newly added episodes and feed update requests
+    max_sleep = config('watcher', 'max_sleep') or 10
     while True:
-        check()
-        time.sleep(10)
+        next_check = check()
+        next_update = process_feed_updates()
+        expire_uploads()
+        registry.save_if_due()
+        due = [d for d in (next_check, next_update) if d]
+        sleep = max_sleep
+        if due:
+            sleep = (min(due) - datetime.now()).total_seconds()
+            sleep = min(max(sleep, 1), max_sleep)
+        time.sleep(sleep)
+
+
+def run_watcher():
+    '''Run the watcher while this instance holds the watcher lease. Other
+    instances wait until the lease is released or expires, so that only one
+    instance in a cluster checks for publications and builds feeds.
+
+    The lease is renewed independently of how long checks and feed builds
+    take. If the lease is lost or the watcher fails, this function returns
+    and the watcher is stopped along with the process.
+    '''
+    lease_duration = config('server', 'lease_duration') or 60
+    holder = holder_id()
+    while not acquire_lease('watcher', holder, lease_duration):
+        time.sleep(lease_duration / 3)
+    logger.info('Acquired watcher lease as %s', holder)
+
+    try:
+        thread = threading.Thread(target=watch, daemon=True)
+        thread.start()
+        # Renew the lease while the watcher is running
+        while thread.is_alive() \
+                and acquire_lease('watcher', holder, lease_duration):
+            thread.join(lease_duration / 3)
+        if thread.is_alive():
+            logger.error('Lost watcher lease')
+        else:
+            logger.error('Watcher stopped unexpectedly')
+    finally:
+        release_lease('watcher', holder)
 
 
 if __name__ == '__main__':
     check()
+    process_feed_updates(force=True)
@@ -14,24 +14,39 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import functools
 import glob
+import hmac
+import json
 import logging
 import os
 import re
+import requests
+import time
 import uuid
 import yaml
 
 from datetime import datetime
-from flask import Flask, request, redirect, render_template, session, \
-                  url_for, send_from_directory
+from flask import Flask, Response, g, request, redirect, render_template, \
+                  session, url_for, send_from_directory
+from sqlalchemy import and_, case, func, tuple_
+from sqlalchemy.orm import aliased
+from werkzeug.security import safe_join
 from functools import wraps
 
+from opencastpodcast.assets import Assets
+from opencastpodcast.cache import FeedCache
 from opencastpodcast.config import config
-from opencastpodcast.db import with_session, Podcast, Episode
-from opencastpodcast.utils import random_string
-from opencastpodcast.opencast import create_series, create_episode
+from opencastpodcast.db import with_session, remove_scoped_session, \
+        Podcast, Episode, IngestJob, JobStatus, Upload, podcast_sort_title
+from opencastpodcast.utils import organizational_unit, random_string
+from opencastpodcast.opencast import create_series, get_episode_url
+from opencastpodcast.images import create_variants, is_variant
 from opencastpodcast.itunes import itunes_categories
-from opencastpodcast.feed import update_feed
+from opencastpodcast.metrics import http_request_duration, registry
+from opencastpodcast.feed import request_feed_update, ENCODINGS
+from opencastpodcast.upload import create_upload, take_upload, write_chunk, \
+        UploadError
 
 
 # Logger
@@ -44,6 +59,14 @@ if config('directories', 'static'):
     flask_config['static_folder'] = config('directories', 'static')
 app = Flask(__name__, **flask_config)
 app.secret_key = config('secret_key') or random_string(64)
+app.use_x_sendfile = config('server', 'sendfile') == 'x-sendfile'
+
+# In-memory cache for feeds
+feed_cache = FeedCache((config('server', 'feed_cache_size') or 64) * 1024**2,
+                       ENCODINGS)
+
+# Fingerprinted static files. Zip codes are looked up by the server.
+assets = Assets(app.static_folder, exclude=('zipcodes.json',))
 
 __error = {}
 __i18n = {}
@@ -70,13 +93,99 @@ def init():
             globals()['__i18n'][lang] = yaml.safe_load(f)
 
 
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    '''Record the duration of the request and share the metrics of this
+    process with the other processes from time to time.
+    '''
+    if 'start' in g:
+        http_request_duration.observe(time.perf_counter() - g.start,
+                                      route=request.endpoint or 'none',
+                                      method=request.method,
+                                      status=response.status_code)
+    registry.save_if_due()
+    return response
+
+
+@app.teardown_appcontext
+def remove_session(exception=None):
+    '''Close the database session used during the request.
+    '''
+    remove_scoped_session()
+
+
+def list_podcasts(db, limit, after=None, unit=None):
+    '''Get a page of podcasts ordered by title along with statistics about
+    their episodes. Only the podcasts of the page are aggregated, so the cost
+    does not depend on the total number of podcasts.
+
+    :param db: Database session to use
+    :param limit: Maximum number of podcasts to return
+    :param after: Identifier of the last podcast of the previous page
+    :param unit: Only list podcasts of this organizational unit
+    :return: List of tuples of podcast, number of published episodes, date of
+             the latest published episode and number of pending episodes
+    '''
+    page = db.query(Podcast)
+    if unit:
+        page = page.where(Podcast.organizational_unit == unit)
+    if after:
+        title = db.query(podcast_sort_title)\
+            .where(Podcast.podcast_id == after)\
+            .scalar_subquery()
+        page = page.where(tuple_(podcast_sort_title, Podcast.podcast_id)
+                          > tuple_(title, after))
+    page = page.order_by(podcast_sort_title, Podcast.podcast_id)\
+        .limit(limit)\
+        .subquery()
+
+    podcast = aliased(Podcast, page)
+    published = Episode.media_url != None
+    pending = and_(Episode.episode_id != None,
+                   Episode.media_url == None,
+                   Episode.publication_failed.is_not(True))
+    return db.query(podcast,
+                    func.count(Episode.media_url),
+                    func.max(case((published, Episode.published))),
+                    func.count(case((pending, 1))))\
+        .outerjoin(Episode, Episode.podcast_id == podcast.podcast_id)\
+        .group_by(*page.c)\
+        .order_by(func.coalesce(podcast.title, ''), podcast.podcast_id)\
+        .all()
+
+
+def organizational_units():
+    '''Get all organizational units defined in the configuration.
+    '''
+    return sorted(config('admins') or {})
+
+
 @app.route('/', methods=['GET'])
 @with_session
 def home(db):
-    podcasts = db.query(Podcast)
+    per_page = config('server', 'podcasts_per_page') or 50
+    unit = request.args.get('ou')
+    podcasts = list_podcasts(db, per_page + 1, request.args.get('after'), unit)
+    next_page = None
+    if len(podcasts) > per_page:
+        podcasts = podcasts[:per_page]
+        next_page = url_for('home', ou=unit,
+                            after=podcasts[-1][0].podcast_id)
+    units = organizational_units()
+    user_unit = organizational_unit(request.remote_user) if units else None
     return render_template('index.html',
                            podcasts=podcasts,
-                           itunes_categories=itunes_categories)
+                           next_page=next_page,
+                           unit=unit,
+                           units=units,
+                           user_unit=user_unit,
+                           itunes_categories=itunes_categories,
+                           page_size=config('feed', 'page_size'))
 
 
 @app.route('/', methods=['POST'])
@@ -96,6 +205,7 @@ def podcast_add(db):
     filename = f'{identifier}.{ext}'
     upload_dir = config('directories', 'upload') or 'upload'
     image.save(os.path.join(upload_dir, filename))
+    variants = create_variants(filename)
 
     # create podcast
     podcast = Podcast()
@@ -107,15 +217,27 @@ def podcast_add(db):
     podcast.category = request.form.get('category')
     podcast.explicit = request.form.get('explicit')
     podcast.image = filename
+    podcast.image_thumbnail = variants.get('thumbnail')
+    podcast.image_cover = variants.get('cover')
+    podcast.organizational_unit = request.form.get('organizational_unit')
+    if podcast.organizational_unit \
+            and podcast.organizational_unit not in organizational_units():
+        return 'Invalid organizational unit', 400
+    if request.form.get('page_size'):
+        try:
+            podcast.page_size = int(request.form.get('page_size'))
+        except ValueError:
+            return 'Invalid page size', 400
+        if podcast.page_size < 1:
+            return 'Invalid page size', 400
 
     create_series(podcast)
 
     db.add(podcast)
+    # Queue creation of the initial RSS feed
+    request_feed_update(db, identifier)
     db.commit()
 
-    # Create initial RSS feed
-    update_feed(identifier)
-
     # Back to home
     return redirect(url_for('home'))
 
@@ -136,67 +258,357 @@ def episode_add(db, identifier):
     episode.episode_id = str(uuid.uuid4())
     episode.podcast_id = identifier
 
-    # check if the post request has a valid media file
-    if 'media' not in request.files or not request.files['media'].filename:
-        return 'Media file is missing', 400
-    media = request.files['media']
-    ext = media.filename.lower().split('.')[-1]
-    if ext not in ('mp3', 'm4a'):
-        return 'Invalid media type', 400
-    filename = f'{identifier}-{episode.episode_id}.{ext}'
-    upload_tmp_dir = config('directories', 'upload_tmp') or 'upload_tmp'
-    media_tmp_path = os.path.join(upload_tmp_dir, filename)
-    media.save(media_tmp_path)
-    episode.media = filename
-
-    # check if the post request has a valid image
-    if 'image' in request.files and request.files['image'].filename:
-        image = request.files['image']
-        ext = image.filename.lower().split('.')[-1]
-        if ext not in ('jpg', 'png', 'jpeg'):
+    # check if the post request has a valid image before taking any files
+    # so that a rejected request can be retried
+    image = request.files.get('image')
+    if image and image.filename:
+        image_ext = image.filename.lower().split('.')[-1]
+        if image_ext not in ('jpg', 'png', 'jpeg'):
             return 'Invalid image type', 400
+
+    # check if the post request has a valid media file or a completed
+    # resumable upload
+    if request.form.get('upload'):
+        try:
+            episode.media = take_upload(db, request.form.get('upload'),
+                                        identifier,
+                                        f'{identifier}-{episode.episode_id}')
+        except UploadError as e:
+            return str(e), e.status
+    elif 'media' in request.files and request.files['media'].filename:
+        media = request.files['media']
+        ext = media.filename.lower().split('.')[-1]
+        if ext not in ('mp3', 'm4a'):
+            return 'Invalid media type', 400
         filename = f'{identifier}-{episode.episode_id}.{ext}'
+        upload_tmp_dir = config('directories', 'upload_tmp') or 'upload_tmp'
+        media.save(os.path.join(upload_tmp_dir, filename))
+        episode.media = filename
+    else:
+        return 'Media file is missing', 400
+
+    if image and image.filename:
+        filename = f'{identifier}-{episode.episode_id}.{image_ext}'
         upload_dir = config('directories', 'upload') or 'upload'
         image.save(os.path.join(upload_dir, filename))
+        variants = create_variants(filename)
         episode.image = filename
+        episode.image_thumbnail = variants.get('thumbnail')
+        episode.image_cover = variants.get('cover')
 
     else:
         # use the podcast's cover image if none was provided
         episode.image = podcast.image
+        episode.image_thumbnail = podcast.image_thumbnail
+        episode.image_cover = podcast.image_cover
 
     episode.title = request.form.get('title')
     episode.description = request.form.get('description')
     episode.author = request.form.get('author')
     episode.published = datetime.now()
 
-    create_episode(episode)
-    logger.info('Deleting temporary file %s', episode.media)
-    os.remove(media_tmp_path)
-
+    # Ingest the episode into Opencast in the background
     db.add(episode)
+    db.add(IngestJob(episode_id=episode.episode_id))
     db.commit()
 
     # Back to podcast page
     return redirect(url_for('podcast', identifier=identifier))
 
 
-@app.route('/i/<image>')
+@app.route('/p/<identifier>/upload', methods=['POST'])
+@with_session
+def upload_create(db, identifier):
+    podcast = db.get(Podcast, identifier)
+    if not podcast:
+        return 'No such podcast', 404
+    try:
+        length = int(request.headers.get('Upload-Length', ''))
+        upload = create_upload(db, identifier,
+                               request.headers.get('Upload-Filename'),
+                               length,
+                               request.headers.get('Upload-Checksum'))
+    except ValueError:
+        return 'Invalid upload length', 400
+    except UploadError as e:
+        return str(e), e.status
+    location = url_for('upload_status', upload_id=upload.upload_id)
+    return {'upload_id': upload.upload_id}, 201, {'Location': location,
+                                                  'Upload-Offset': '0'}
+
+
+@app.route('/u/<upload_id>')
 @with_session
-def image(db, image):
+def upload_status(db, upload_id):
+    upload = db.get(Upload, upload_id)
+    if not upload:
+        return 'No such upload', 404
+    headers = {'Upload-Offset': str(upload.offset),
+               'Upload-Length': str(upload.length),
+               'Cache-Control': 'no-store'}
+    return {'offset': upload.offset, 'length': upload.length}, 200, headers
+
+
+@app.route('/u/<upload_id>', methods=['PATCH'])
+@with_session
+def upload_chunk(db, upload_id):
+    upload = db.get(Upload, upload_id)
+    if not upload:
+        return 'No such upload', 404
+    if request.content_type != 'application/offset+octet-stream':
+        return 'Invalid content type', 415
+    try:
+        offset = int(request.headers.get('Upload-Offset', ''))
+        offset = write_chunk(db, upload, offset, request.stream,
+                             request.headers.get('Upload-Checksum'))
+    except ValueError:
+        return 'Invalid upload offset', 400
+    except UploadError as e:
+        db.rollback()
+        return str(e), e.status, {'Upload-Offset': str(upload.offset)}
+    return '', 204, {'Upload-Offset': str(offset)}
+
+
+@app.route('/p/<identifier>/<episode_id>/status')
+@with_session
+def episode_status(db, identifier, episode_id):
+    episode = db.query(Episode)\
+        .where(Episode.podcast_id == identifier)\
+        .where(Episode.episode_id == episode_id)\
+        .one_or_none()
+    if not episode:
+        return {'error': 'No such episode'}, 404
+    job = db.get(IngestJob, episode_id)
+    status = {'published': bool(episode.media_url),
+              'publication_failed': bool(episode.publication_failed)}
+    if job:
+        status['ingest'] = {'status': job.status.name,
+                            'attempts': job.attempts,
+                            'error': job.error,
+                            'updated': job.updated.isoformat()}
+    return status
+
+
+@app.route('/api/notify', methods=['POST'])
+@with_session
+def notify(db):
+    '''Endpoint for Opencast's HTTP notification workflow operation, telling
+    us that an episode has been published.
+    '''
+    token = config('opencast', 'notify_token')
+    if not token:
+        return 'Notifications are disabled', 404
+    auth = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    provided = request.args.get('token') or auth
+    if not hmac.compare_digest(provided.encode(), str(token).encode()):
+        return 'Invalid token', 403
+
+    episode_id = request.form.get('mediaPackageIdentifier') \
+        or request.form.get('mediaPackageId')
+    episode = db.get(Episode, episode_id or '')
+    if not episode:
+        return 'No such episode', 404
+    if episode.media_url:
+        return 'Episode already published', 200
+
+    logger.info('Episode %s: Received publication notification', episode_id)
+    try:
+        track = get_episode_url(episode_id)
+    except requests.RequestException as e:
+        logger.warning('Episode %s: Could not look up publication: %s',
+                       episode_id, e)
+        track = None
+    episode.publication_failed = False
+    if not track:
+        # The search index may not be updated yet or Opencast may be
+        # unavailable. Let the watcher check soon.
+        episode.check_attempts = 0
+        episode.next_check = datetime.now()
+        db.commit()
+        return 'Publication not yet found', 202
+
+    logger.info('Found %s', track['url'])
+    episode.media_url = track.get('url')
+    episode.media_size = track.get('size')
+    episode.media_duration = track.get('duration')
+    episode.next_check = None
+    request_feed_update(db, episode.podcast_id)
+    db.commit()
+    return 'Episode published', 200
+
+
+@app.route('/metrics')
+def metrics():
+    '''Metrics of the web server, the watcher and the ingest workers in the
+    Prometheus text format.
+    '''
+    token = config('metrics', 'token')
+    if token:
+        auth = request.headers.get('Authorization', '')
+        provided = auth.removeprefix('Bearer ')
+        if not hmac.compare_digest(provided.encode(), str(token).encode()):
+            return 'Invalid token', 403
+    return Response(registry.exposition(),
+                    mimetype='text/plain; version=0.0.4')
+
+
+def accel_redirect(location, filename, max_age=None):
+    '''Let Nginx deliver a file from an internal location if configured.
+
+    :param location: Key of the internal location in the configuration
+    :param filename: Path of the file relative to the location
+    :param max_age: Seconds clients may cache the file
+    :return: Response or None if not configured
+    '''
+    if config('server', 'sendfile') != 'x-accel-redirect':
+        return None
+    locations = config('server', 'sendfile_locations') or {}
+    prefix = locations.get(location)
+    if not prefix:
+        logger.warning('No sendfile location configured for %s', location)
+        return None
+    response = Response()
+    response.headers['X-Accel-Redirect'] = f'{prefix.rstrip("/")}/{filename}'
+    # Let Nginx determine the content type
+    del response.headers['Content-Type']
+    if max_age:
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+    return response
+
+
+@app.route('/i/<image>')
+def image(image):
     upload_dir = os.path.abspath(config('directories', 'upload') or 'upload')
     if '/' in image:
         return 'No such image', 404
-    return send_from_directory(upload_dir, image)
+    # Uploaded images are never modified. Variants are named after their
+    # content and can be cached forever.
+    immutable = is_variant(image)
+    max_age = 365 * 24 * 3600 if immutable \
+        else config('server', 'image_max_age') or 7 * 24 * 3600
+    response = accel_redirect('upload', image, max_age) \
+        or send_from_directory(upload_dir, image, max_age=max_age)
+    response.cache_control.immutable = immutable
+    return response
+
+
+def send_variants(variants, mimetype, etag, modified=None, max_age=None,
+                  immutable=False):
+    '''Send content using a precompressed variant if the client accepts it
+    and answer conditional requests based on the ETag and modification date.
+
+    :param variants: Dictionary mapping content encodings to content. The
+                     uncompressed content uses the encoding None.
+    :param mimetype: Content type
+    :param etag: ETag of the uncompressed content
+    :param modified: Modification date of the content
+    :param max_age: Seconds clients may cache the content
+    :param immutable: If the content never changes
+    :return: Response
+    '''
+    encoding = None
+    for variant, _ in ENCODINGS:
+        if request.accept_encodings[variant] and variant in variants:
+            encoding = variant
+            break
+
+    response = Response(variants[encoding], mimetype=mimetype)
+    # Every variant needs its own strong ETag
+    response.set_etag(f'{etag}-{encoding}' if encoding else etag)
+    response.last_modified = modified
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    if max_age:
+        response.cache_control.public = True
+        response.cache_control.max_age = max_age
+        response.cache_control.immutable = immutable
+    else:
+        response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def send_feed(feed_dir, filename, max_age=None, immutable=False):
+    '''Send a feed from the in-memory cache, using the ETag and modification
+    date written along with the feed.
+
+    :param feed_dir: Directory containing the feed
+    :param filename: Name of the feed file
+    :param max_age: Seconds clients may cache the feed
+    :param immutable: If the feed never changes
+    :return: Response
+    '''
+    path = safe_join(feed_dir, filename)
+    feed = feed_cache.get(path) if path else None
+    if not feed:
+        return 'No such feed', 404
+    return send_variants(feed.variants, 'application/xml', feed.etag,
+                         feed.modified, max_age, immutable)
+
+
+@app.template_global()
+def asset_url(filename):
+    '''Get the URL of a fingerprinted static file for use in templates.
+
+    :param filename: Path of the file relative to the static folder
+    :return: URL of the asset
+    '''
+    name = assets.name(filename)
+    if not name:
+        return url_for('static', filename=filename)
+    return url_for('asset', name=name)
+
+
+@app.route('/assets/<path:name>')
+def asset(name):
+    asset = assets.get(name)
+    if not asset:
+        return 'No such asset', 404
+    # Assets are named after their content
+    return send_variants(asset.variants, asset.mimetype, asset.etag,
+                         max_age=365 * 24 * 3600, immutable=True)
+
+
+@functools.cache
+def zipcodes():
+    '''Load the table mapping postal codes to cities.
+    '''
+    with open(os.path.join(app.static_folder, 'zipcodes.json'), 'r') as f:
+        return json.load(f)
+
+
+@app.route('/api/zipcode/<code>')
+def zipcode(code):
+    '''Look up the city of a postal code so that clients do not need to
+    download the whole table.
+    '''
+    return {'city': zipcodes().get(code)}, \
+        {'Cache-Control': f'public, max-age={24 * 3600}'}
 
 
 @app.route('/r/<identifier>.xml')
-@with_session
-def rss(db, identifier):
+def rss(identifier):
     feed_dir = os.path.abspath(config('directories', 'feeds') or 'feeds')
     if '/' in identifier:
         return 'No such feed', 404
     logger.debug('Delivering feed for %s', identifier)
-    return send_from_directory(feed_dir, f'{identifier}.xml')
+    return accel_redirect('feeds', f'{identifier}.xml') \
+        or send_feed(feed_dir, f'{identifier}.xml')
+
+
+@app.route('/r/<identifier>/<int:page>.xml')
+def rss_archive(identifier, page):
+    feed_dir = os.path.abspath(config('directories', 'feeds') or 'feeds')
+    if '/' in identifier:
+        return 'No such feed', 404
+    logger.debug('Delivering archive page %i for %s', page, identifier)
+    # Archive pages rarely change, but they do if episodes or the podcast
+    # are edited. Clients revalidate them using their ETag.
+    max_age = config('feed', 'archive_max_age') or 24 * 3600
+    return accel_redirect('feeds', f'{identifier}/{page}.xml', max_age) \
+        or send_feed(os.path.join(feed_dir, identifier), f'{page}.xml',
+                     max_age=max_age)
 
 
 init()